@@ -0,0 +1,241 @@
+import os
+import time
+import fcntl
+import shutil
+import subprocess
+import confedit
+from logger import log, err, inf
+
+# login.defs ENCRYPT_METHOD to openssl passwd and mkpasswd options
+OPENSSL_METHODS = {"SHA512": "-6", "SHA256": "-5", "MD5": "-1"}
+MKPASSWD_METHODS = {"YESCRYPT": "yescrypt", "BLOWFISH": "bcrypt", "BCRYPT": "bcrypt"}
+
+# field count of each database line
+DATABASES = {
+    "passwd": 7,
+    "shadow": 9,
+    "group": 4,
+    "gshadow": 4,
+}
+
+
+def read_login_defs(root="/"):
+    """parse etc/login.defs into a dict"""
+    defs = {}
+    path = os.path.join(root, "etc/login.defs")
+    if not os.path.isfile(path):
+        return defs
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            elements = line.split(None, 1)
+            if len(elements) == 2:
+                defs[elements[0]] = elements[1].strip()
+    return defs
+
+
+def hash_password(password, method="SHA512"):
+    """hash password with the given login.defs ENCRYPT_METHOD, None without a tool for it"""
+    method = method.upper()
+    if method in MKPASSWD_METHODS:
+        command = ["mkpasswd", "--method=" + MKPASSWD_METHODS[method], "--stdin"]
+    elif method in OPENSSL_METHODS:
+        command = ["openssl", "passwd", OPENSSL_METHODS[method], "-stdin"]
+    else:
+        err("No tool to hash passwords with {}".format(method))
+        return None
+    if shutil.which(command[0]) is None:
+        # never a weaker method than the target asks for
+        err("{} is needed to hash passwords with {}".format(command[0], method))
+        return None
+    # the password goes through a pipe, never to the command line
+    result = subprocess.run(command, input=(password + "\n").encode("utf-8"),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    hashed = result.stdout.decode("utf-8").strip()
+    if result.returncode != 0 or not hashed.startswith("$"):
+        err("{} cannot hash with {}".format(command[0], method))
+        return None
+    return hashed
+
+
+class AccountDatabase:
+    ''' Edits passwd, shadow, group and gshadow of a root directory in one locked transaction '''
+
+    def __init__(self, root="/target"):
+        self.root = root
+        self.defs = read_login_defs(root)
+        self.tables = {}
+        self.lockfd = None
+
+    def __enter__(self):
+        self.lock()
+        self.load()
+        return self
+
+    def __exit__(self, typevar, value, traceback):
+        try:
+            if typevar is None:
+                self.commit()
+        finally:
+            self.unlock()
+        return False
+
+    def path(self, name):
+        return os.path.join(self.root, "etc", name)
+
+    def lock(self):
+        # same lock file as lckpwdf(3)
+        self.lockfd = os.open(self.path(".pwd.lock"),
+                              os.O_WRONLY | os.O_CREAT, 0o600)
+        fcntl.lockf(self.lockfd, fcntl.LOCK_EX)
+
+    def unlock(self):
+        if self.lockfd is not None:
+            fcntl.lockf(self.lockfd, fcntl.LOCK_UN)
+            os.close(self.lockfd)
+            self.lockfd = None
+
+    def load(self):
+        for name, fields in DATABASES.items():
+            rows = []
+            if os.path.isfile(self.path(name)):
+                with open(self.path(name), "r") as f:
+                    for line in f.read().splitlines():
+                        if not line.strip():
+                            continue
+                        row = line.split(":")
+                        row += [""] * (fields - len(row))
+                        rows.append(row)
+            self.tables[name] = rows
+
+    def commit(self):
+        for name, rows in self.tables.items():
+            path = self.path(name)
+            if not os.path.isfile(path) and not rows:
+                continue
+            content = "".join(":".join(row) + "\n" for row in rows)
+            mode = None
+            if os.path.isfile(path):
+                shutil.copy2(path, path + "-")
+            elif "shadow" in name:
+                mode = 0o600
+            confedit.atomic_write(path, content, mode)
+        log("Account databases written to {}".format(self.root))
+
+    def find(self, table, name):
+        for row in self.tables[table]:
+            if row[0] == name:
+                return row
+        return None
+
+    def _free_id(self, table, start, end, reverse=False):
+        used = set()
+        for row in self.tables[table]:
+            try:
+                used.add(int(row[2]))
+            except ValueError:
+                pass
+        candidates = range(end, start - 1, -1) if reverse else range(start, end + 1)
+        if not reverse:
+            # continue after the highest id in range, like useradd
+            in_range = [i for i in used if start <= i <= end]
+            if in_range:
+                candidates = range(max(in_range) + 1, end + 1)
+        for i in candidates:
+            if i not in used:
+                return i
+        raise ValueError("No free id available in {}".format(table))
+
+    def _def(self, key, default):
+        try:
+            return int(str(self.defs.get(key, default)))
+        except ValueError:
+            return default
+
+    def add_group(self, name, system=False, gid=None):
+        if self.find("group", name):
+            return int(self.find("group", name)[2])
+        if gid is None or self.find_gid(gid):
+            if system:
+                gid = self._free_id("group", self._def("SYS_GID_MIN", 101),
+                                    self._def("SYS_GID_MAX", 999), reverse=True)
+            else:
+                gid = self._free_id("group", self._def("GID_MIN", 1000),
+                                    self._def("GID_MAX", 60000))
+        self.tables["group"].append([name, "x", str(gid), ""])
+        self.tables["gshadow"].append([name, "!", "", ""])
+        return gid
+
+    def find_gid(self, gid):
+        for row in self.tables["group"]:
+            if row[2] == str(gid):
+                return row
+        return None
+
+    def add_members(self, user, groups):
+        for group in groups:
+            for table, column in (("group", 3), ("gshadow", 3)):
+                row = self.find(table, group)
+                if row is None:
+                    if table == "group":
+                        err("Group {} does not exist, skipping.".format(group))
+                    continue
+                members = [m for m in row[column].split(",") if m]
+                if user not in members:
+                    members.append(user)
+                row[column] = ",".join(members)
+
+    def add_user(self, name, realname="", shell="/bin/bash", home=None):
+        home = home or "/home/" + name
+        row = self.find("passwd", name)
+        if row:
+            row[4], row[6] = realname, shell
+            return int(row[2]), int(row[3])
+        uid = self._free_id("passwd", self._def("UID_MIN", 1000),
+                            self._def("UID_MAX", 60000))
+        if self.defs.get("USERGROUPS_ENAB", "yes").lower() == "yes":
+            gid = self.add_group(name, gid=uid)
+        else:
+            gid = self._def("USERS_GID", 100)
+        self.tables["passwd"].append(
+            [name, "x", str(uid), str(gid), realname, home, shell])
+        self.tables["shadow"].append(
+            [name, "!", str(int(time.time() // 86400)), "0", "99999", "7", "", "", ""])
+        return uid, gid
+
+    def set_password(self, name, password):
+        """False if the password could not be hashed, nothing is changed then"""
+        hashed = hash_password(password, self.defs.get("ENCRYPT_METHOD", "SHA512"))
+        if hashed is None:
+            return False
+        row = self.find("shadow", name)
+        if row is None:
+            row = [name, "", "", "0", "99999", "7", "", "", ""]
+            self.tables["shadow"].append(row)
+        row[1] = hashed
+        row[2] = str(int(time.time() // 86400))
+        return True
+
+    def create_home(self, name):
+        row = self.find("passwd", name)
+        uid, gid, home = int(row[2]), int(row[3]), row[5]
+        target = os.path.join(self.root, home.lstrip("/"))
+        skel = self.path("skel")
+        if not os.path.exists(target):
+            if os.path.isdir(skel):
+                shutil.copytree(skel, target, symlinks=True)
+            else:
+                os.makedirs(target)
+        for directory, dirs, files in os.walk(target):
+            os.lchown(directory, uid, gid)
+            for f in dirs + files:
+                os.lchown(os.path.join(directory, f), uid, gid)
+        try:
+            umask = int(self.defs.get("UMASK", "077"), 8)
+            mode = int(self.defs.get("HOME_MODE", "0"), 8) or (0o777 & ~umask)
+        except ValueError:
+            mode = 0o700
+        os.chmod(target, mode)
+        inf("Home directory {} created".format(home))
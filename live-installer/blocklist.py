@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import random
+import socket
+import config
+import confedit
+from logger import log, err, inf
+
+BRANDING_HOSTS = "./branding/hosts"
+LOCAL_NAMES = ("localhost", "localhost.localdomain", "local", "broadcasthost",
+               "ip6-localhost", "ip6-loopback")
+
+NM_CONF = "/etc/NetworkManager/conf.d/17g-blocklist.conf"
+
+# Local resolvers which keep their zones in an indexed (hashed / tree) form.
+# NetworkManager points the system at them: it runs its own dnsmasq with
+# dns=dnsmasq, unbound is a recursive resolver of its own and becomes the
+# global name server.
+BACKENDS = {
+    "dnsmasq": {
+        "check": "/usr/bin/dnsmasq",
+        "path": "/etc/NetworkManager/dnsmasq.d/17g-blocklist.conf",
+        "header": "# 17g ad-blocking list\n",
+        "line": "address=/{}/\n",
+        "service": None,
+        "networkmanager": "[main]\ndns=dnsmasq\n",
+    },
+    "unbound": {
+        "check": "/etc/unbound/unbound.conf",
+        "path": "/etc/unbound/unbound.conf.d/17g-blocklist.conf",
+        "header": "# 17g ad-blocking list\nserver:\n",
+        "line": "    local-zone: \"{}.\" always_nxdomain\n",
+        "service": "unbound",
+        "networkmanager": "[global-dns-domain-*]\nservers=127.0.0.1\n",
+    },
+}
+
+
+def read_domains(path=BRANDING_HOSTS):
+    """stream unique blocked domains out of a hosts formatted list"""
+    seen = set()
+    with open(path, "r", errors="ignore") as f:
+        for line in f:
+            line = line.split("#", 1)[0].split()
+            if len(line) < 2:
+                continue
+            for domain in line[1:]:
+                domain = domain.lower().rstrip(".")
+                if domain in LOCAL_NAMES or domain in seen:
+                    continue
+                seen.add(domain)
+                yield domain
+
+
+def detect_backend(target="/target"):
+    backend = config.get("blocklist_backend", "hosts")
+    if backend == "auto":
+        backend = "hosts"
+        for name in ("unbound", "dnsmasq"):
+            if os.path.exists(target + BACKENDS[name]["check"]):
+                backend = name
+                break
+    return backend
+
+
+def write_hosts(hostsfh, path=BRANDING_HOSTS):
+    """append the deduplicated list to an open hosts file"""
+    count = 0
+    for domain in read_domains(path):
+        hostsfh.write("0.0.0.0 {}\n".format(domain))
+        count += 1
+    return count
+
+
+def write_resolver(backend, target="/target", path=BRANDING_HOSTS):
+    """write the deduplicated list as a local resolver zone config"""
+    info = BACKENDS[backend]
+    dest = target + info["path"]
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + ".new"
+    count = 0
+    with open(tmp, "w") as f:
+        f.write(info["header"])
+        for domain in read_domains(path):
+            f.write(info["line"].format(domain))
+            count += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, dest)
+    if backend == "unbound":
+        conf = target + "/etc/unbound/unbound.conf"
+        include = 'include: "/etc/unbound/unbound.conf.d/*.conf"'
+        with open(conf, "r") as f:
+            content = f.read()
+        if include not in content:
+            confedit.atomic_write(conf, content.rstrip("\n") + "\n" + include + "\n")
+    return count
+
+
+def enable_resolver(backend, target="/target"):
+    """make the installed system resolve through the local resolver"""
+    from utils import run  # not needed, nor importable without gi, by the benchmark
+    info = BACKENDS[backend]
+    confedit.atomic_write(target + NM_CONF, info["networkmanager"])
+    if info["service"]:
+        run("chroot||systemctl enable {}".format(info["service"]))
+
+
+def deploy(hostsfh, target="/target"):
+    """install branding/hosts either into /etc/hosts or into a local resolver"""
+    if not os.path.isfile(BRANDING_HOSTS):
+        return
+    backend = detect_backend(target)
+    if backend == "none":
+        return
+    if backend in BACKENDS:
+        if os.path.exists(target + BACKENDS[backend]["check"]) and \
+                os.path.isdir(target + os.path.dirname(NM_CONF)):
+            count = write_resolver(backend, target)
+            enable_resolver(backend, target)
+            inf("Blocklist: {} domains written for {}".format(count, backend))
+            return
+        err("Blocklist backend {} or NetworkManager is not installed in target, using /etc/hosts".format(backend))
+    count = write_hosts(hostsfh)
+    inf("Blocklist: {} domains appended to /etc/hosts".format(count))
+
+
+def benchmark(path=BRANDING_HOSTS, lookups=200):
+    """getaddrinfo latency of listed and unlisted names with the setup in use,
+    run it once with the hosts backend and once with a resolver to compare"""
+    setup = "resolver" if os.path.exists(NM_CONF) else "hosts"
+    domains = list(read_domains(path))
+    samples = {
+        # spread over the list, /etc/hosts is searched from the top
+        "listed": random.sample(domains, min(lookups, len(domains))),
+        # misses walk the whole hosts file before going to DNS
+        "unlisted": ["miss{}.invalid".format(i) for i in range(lookups)],
+    }
+    log("setup: {}, domains: {}, lookups: {}".format(setup, len(domains), lookups))
+    for kind, names in samples.items():
+        times = []
+        for name in names:
+            start = time.perf_counter()
+            try:
+                socket.getaddrinfo(name, None)
+            except socket.gaierror:
+                pass  # NXDOMAIN is the expected answer of a resolver
+            times.append(time.perf_counter() - start)
+        times.sort()
+        if times:
+            log("{:8s}: {:10.3f} ms median, {:10.3f} ms p95".format(
+                kind, times[len(times) // 2] * 1e3, times[len(times) * 95 // 100] * 1e3))
+
+
+if __name__ == "__main__":
+    if "--benchmark" in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith("--")]
+        benchmark(*args[:1])
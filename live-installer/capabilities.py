@@ -0,0 +1,92 @@
+import os
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from logger import log
+
+TOOL_DIRS = ("/bin", "/sbin", "/usr/bin", "/usr/sbin")
+
+
+def probe_efi():
+    # Are we running under with efi ?
+    try:
+        subprocess.call(["modprobe", "efivars"],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+    return os.path.exists("/proc/efi") or os.path.exists("/sys/firmware/efi")
+
+
+def probe_kernel_version():
+    return os.uname().release
+
+
+def probe_mem_total_kb():
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1])
+    return 0
+
+
+def probe_tools():
+    tools = set()
+    for path in TOOL_DIRS:
+        try:
+            for name in os.listdir(path):
+                if os.access(os.path.join(path, name), os.X_OK):
+                    tools.add(name)
+        except OSError:
+            pass
+    return frozenset(tools)
+
+
+class Capabilities:
+    ''' Facts about the live host, probed once and cached '''
+
+    PROBES = {
+        "efi": probe_efi,
+        "kernel_version": probe_kernel_version,
+        "mem_total_kb": probe_mem_total_kb,
+        "tools": probe_tools,
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def __getattr__(self, name):
+        if name not in Capabilities.PROBES:
+            raise AttributeError(name)
+        with self._lock:
+            if name in self._values:
+                return self._values[name]
+        value = Capabilities.PROBES[name]()
+        with self._lock:
+            return self._values.setdefault(name, value)
+
+    @property
+    def filesystems(self):
+        """ names of the mkfs.* helpers available """
+        return sorted(t[5:] for t in self.tools if t.startswith("mkfs.") and len(t) > 5)
+
+    def has_tool(self, name):
+        return name in self.tools
+
+    def probe_all(self):
+        """ probe everything in parallel, returns when done """
+        with ThreadPoolExecutor(max_workers=len(Capabilities.PROBES)) as pool:
+            list(pool.map(lambda name: getattr(self, name), Capabilities.PROBES))
+        log("Host: efi={} kernel={} memory={}kB".format(
+            self.efi, self.kernel_version, self.mem_total_kb))
+
+    def invalidate(self, name=None):
+        """ forget one (or all) cached values, e.g. after loading a module """
+        with self._lock:
+            if name is None:
+                self._values.clear()
+            else:
+                self._values.pop(name, None)
+
+
+host = Capabilities()
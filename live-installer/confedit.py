@@ -0,0 +1,137 @@
+import os
+import re
+from logger import log
+
+
+def atomic_write(path, content, mode=None):
+    """write content to path with write, fsync, rename"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    uid = gid = None
+    if os.path.exists(path):
+        stat = os.stat(path)
+        uid, gid = stat.st_uid, stat.st_gid
+        if mode is None:
+            mode = stat.st_mode & 0o7777
+    if mode is None:
+        mode = 0o644
+    directory = os.path.dirname(path) or "."
+    tmp = os.path.join(directory, ".{}.new".format(os.path.basename(path)))
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.write(fd, content)
+        if uid is not None:
+            os.fchown(fd, uid, gid)
+        os.fchmod(fd, mode)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    dirfd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def atomic_symlink(target, path):
+    """replace path with a symlink to target in one rename"""
+    tmp = os.path.join(os.path.dirname(path), ".{}.new".format(os.path.basename(path)))
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+
+class ConfigFile:
+    ''' Base class: load once, edit lines in memory, write once on save() '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+        self.changed = False
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.lines = f.read().splitlines()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typevar, value, traceback):
+        if typevar is None:
+            self.save()
+        return False
+
+    def save(self):
+        if not self.changed:
+            return
+        atomic_write(self.path, "\n".join(self.lines) + "\n")
+        log("Written: {}".format(self.path))
+        self.changed = False
+
+    def _replace(self, index, line):
+        if self.lines[index] != line:
+            self.lines[index] = line
+            self.changed = True
+
+    def _insert(self, index, line):
+        self.lines.insert(index, line)
+        self.changed = True
+
+
+class KeyValueFile(ConfigFile):
+    ''' Shell style KEY=value files (console-setup, vconsole.conf, locale.conf ...) '''
+
+    def get(self, key, default=None):
+        for line in self.lines:
+            if line.startswith(key + "="):
+                return line.split("=", 1)[1].strip().strip("\"'")
+        return default
+
+    def set(self, key, value, quote=True, append=True):
+        if quote:
+            value = "\"{}\"".format(value)
+        line = "{}={}".format(key, value)
+        found = False
+        for i, old in enumerate(self.lines):
+            if old.startswith(key + "="):
+                self._replace(i, line)
+                found = True
+        if not found and append:
+            self._insert(len(self.lines), line)
+
+
+class IniFile(ConfigFile):
+    ''' ini style files with [sections] (lightdm.conf ...) '''
+
+    def _section_range(self, section):
+        start, end = None, len(self.lines)
+        for i, line in enumerate(self.lines):
+            stripped = line.strip()
+            if stripped.startswith("[") and stripped.endswith("]"):
+                if start is not None:
+                    end = i
+                    break
+                if stripped[1:-1] == section:
+                    start = i + 1
+        return start, end
+
+    def set(self, key, value, section=None, uncomment=True):
+        """set key in section (every section if None), enabling commented defaults"""
+        pattern = re.compile(r"^{}{}\s*=".format("#?" if uncomment else "", re.escape(key)))
+        start, end = (0, len(self.lines))
+        if section is not None:
+            start, end = self._section_range(section)
+            if start is None:
+                self._insert(len(self.lines), "[{}]".format(section))
+                start = end = len(self.lines)
+        line = "{}={}".format(key, value)
+        found = False
+        for i in range(start, end):
+            if pattern.match(self.lines[i]):
+                self._replace(i, line)
+                found = True
+        if not found and section is not None:
+            while end > start and not self.lines[end - 1].strip():
+                end -= 1
+            self._insert(end, line)
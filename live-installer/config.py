@@ -1,6 +1,6 @@
 import os
 import sys
-import subprocess
+import capabilities
 import yaml
 from glob import glob
 from logger import log, err, inf
@@ -111,7 +111,7 @@ def update_initramfs():
     for command in initramfs["commands"]:
         log(initramfs)
         if "{kernel_version}" in command:
-            kernel_version = subprocess.getoutput("uname -r")
+            kernel_version = capabilities.host.kernel_version
             command = command.replace('{kernel_version}', kernel_version)
 
             commands.append(command)
@@ -0,0 +1,379 @@
+import os
+import stat
+import time
+import errno
+import fnmatch
+import shutil
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import verify
+from logger import log, err
+
+# Copies the live system to the target with everything rsync -aAXH --no-D
+# keeps: ownership, modes, timestamps, xattrs (ACLs included) and hard
+# links. In streaming mode the pages of copied files are dropped from the
+# page cache, so the live session keeps its own working set.
+
+CHUNK = 8 * 1024 * 1024
+# written files are dropped from the cache once this many newer ones
+# followed, by then their writeback has usually completed
+WRITEBACK_DELAY = 64
+
+
+def load_layout(path):
+    """ {relpath: position} from a build-time list of files in on-media order """
+    layout = {}
+    if not path or not os.path.isfile(path):
+        return layout
+    with open(path, "r", errors="surrogateescape") as f:
+        for line in f:
+            relpath = line.rstrip("\n").lstrip("/")
+            if relpath and relpath not in layout:
+                layout[relpath] = len(layout)
+    log("Copy layout: {} files from {}".format(len(layout), path))
+    return layout
+
+
+def rsync_command(source, target, exclude=(), delta=False, keep=()):
+    """ argv of the rsync run equivalent to a Copier, patterns anchored at the source """
+    command = ["rsync", "--verbose", "--archive", "--no-D", "--acls", "--hard-links", "--xattrs"]
+    command += ["--exclude=/" + e.strip("/") for e in exclude if e.strip("/")]
+    if delta:
+        # excluded paths are not deleted, the kept ones and /home neither
+        command.append("--delete")
+        command += ["--exclude=/" + k.strip("/") for k in list(keep) + ["home"] if k.strip("/")]
+    return command + [source.rstrip("/") + "/", target.rstrip("/") + "/"]
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            h.update(block)
+    return h.digest()
+
+
+class Copier:
+    ''' Parallel tree copy with metadata, hardlinks and optional cache dropping '''
+
+    def __init__(self, source, target, exclude=(), workers=4, streaming=True, progress=None,
+                 order="layout", layout=None, delta=False, compare="mtime", keep=(),
+                 digest=False):
+        self.source = source.rstrip("/") or "/"
+        self.target = target.rstrip("/") or "/"
+        self.exclude = [e.strip("/") for e in exclude]
+        self.workers = max(1, workers)
+        self.limit = self.workers
+        self.running = 0
+        self.streaming = streaming
+        self.progress = progress
+        self.order = order
+        self.layout = layout or {}
+        # delta: update an existing target, copy changed files, delete extra ones
+        self.delta = delta
+        self.compare = compare
+        self.keep = [k.strip("/") for k in keep]
+        # digest: hash file data while copying, {relpath: digest} for verify
+        self.digest = digest
+        self.digests = {}
+        self.cond = threading.Condition()
+        self.lock = threading.Lock()
+        self.inodes = {}
+        self.links = []
+        self.dirs = []
+        self.written = deque()
+        self.entries = None
+        self.stats = {"files": 0, "dirs": 0, "symlinks": 0, "hardlinks": 0,
+                      "bytes": 0, "errors": 0, "dropped_source_bytes": 0,
+                      "dropped_target_bytes": 0, "unchanged": 0, "deleted": 0}
+
+    def excluded(self, relpath):
+        return any(fnmatch.fnmatch(relpath, e) for e in self.exclude)
+
+    def throttle(self, throttled):
+        """ memory guard callback: copy one file at a time while memory is short """
+        with self.cond:
+            self.limit = 1 if throttled else self.workers
+            self.cond.notify_all()
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def scan(self):
+        """ (relpath, lstat) of everything to copy, parents before children """
+        stack = [""]
+        while stack:
+            reldir = stack.pop()
+            try:
+                entries = sorted(os.scandir(os.path.join(self.source, reldir)),
+                                 key=lambda e: e.name)
+            except OSError as e:
+                err("Cannot read {}: {}".format(reldir, e))
+                self._count("errors")
+                continue
+            subdirs = []
+            for entry in entries:
+                relpath = os.path.join(reldir, entry.name)
+                if self.excluded(relpath):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                yield relpath, st
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(relpath)
+            stack.extend(reversed(subdirs))
+
+    def copy_metadata(self, src, dst, st, fd=None):
+        follow = not stat.S_ISLNK(st.st_mode)
+        target = fd if fd is not None else dst
+        try:
+            if fd is not None:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            else:
+                os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=follow)
+            if follow:
+                # after chown, which clears setuid bits
+                os.chmod(target, stat.S_IMODE(st.st_mode))
+            for name in os.listxattr(src, follow_symlinks=follow):
+                # security.capability is also reset by chown, so set after it
+                os.setxattr(target, name, os.getxattr(src, name, follow_symlinks=follow),
+                            follow_symlinks=follow)
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM) or follow:
+                err("Metadata of {}: {}".format(dst, e))
+                self._count("errors")
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 **({} if fd is not None else {"follow_symlinks": follow}))
+
+    def copy_file(self, relpath, st):
+        src = os.path.join(self.source, relpath)
+        dst = os.path.join(self.target, relpath)
+        with self.cond:
+            while self.running >= self.limit:
+                self.cond.wait()
+            self.running += 1
+        try:
+            with open(src, "rb") as fsrc:
+                fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    if self.digest:
+                        self.digests[relpath] = self.copy_data_hashed(fsrc.fileno(), fd, st.st_size)
+                    else:
+                        offset = 0
+                        while offset < st.st_size:
+                            sent = os.sendfile(fd, fsrc.fileno(), offset, min(CHUNK, st.st_size - offset))
+                            if sent == 0:
+                                break
+                            offset += sent
+                    self.copy_metadata(src, dst, st, fd)
+                    if self.streaming:
+                        os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                        # starts writeback of the dirty pages, dropped later
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+            self._count("files")
+            self._count("bytes", st.st_size)
+            if self.streaming:
+                self._count("dropped_source_bytes", st.st_size)
+                self.drop_written(dst, st.st_size)
+        except OSError as e:
+            err("Cannot copy {}: {}".format(relpath, e))
+            self._count("errors")
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify()
+        if self.progress:
+            self.progress(relpath)
+
+    def copy_data_hashed(self, fd_in, fd_out, size):
+        """ copy through user space, the data is hashed on the way """
+        h = verify.new_hash()
+        offset = 0
+        while offset < size:
+            block = os.pread(fd_in, min(CHUNK, size - offset), offset)
+            if not block:
+                break
+            h.update(block)
+            view = memoryview(block)
+            while view:
+                view = view[os.write(fd_out, view):]
+            offset += len(block)
+        return h.digest()
+
+    def drop_written(self, path, size):
+        with self.lock:
+            self.written.append((path, size))
+            if len(self.written) <= WRITEBACK_DELAY:
+                return
+            path, size = self.written.popleft()
+        self._drop(path, size)
+
+    def _drop(self, path, size):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+            self._count("dropped_target_bytes", size)
+        except OSError:
+            pass
+
+    def unchanged(self, relpath, st):
+        """ delta mode: is the target copy of a regular file up to date """
+        dst = os.path.join(self.target, relpath)
+        try:
+            dst_st = os.lstat(dst)
+        except OSError:
+            return False
+        if not stat.S_ISREG(dst_st.st_mode) or dst_st.st_size != st.st_size:
+            return False
+        if self.compare == "hash":
+            return file_digest(dst) == file_digest(os.path.join(self.source, relpath))
+        return dst_st.st_mtime_ns == st.st_mtime_ns
+
+    def protected(self, relpath):
+        return any(fnmatch.fnmatch(relpath, k) or relpath.startswith(k + "/")
+                   for k in self.keep + self.exclude)
+
+    def prune(self, entries):
+        """ delta mode: delete what the image does not contain, except excluded and kept paths """
+        wanted = set(relpath for relpath, st in entries)
+        doomed = []
+        for root, dirs, files in os.walk(self.target):
+            # other filesystems mounted in the target (/boot, the ESP) are not the image's
+            dirs[:] = [d for d in dirs if not os.path.ismount(os.path.join(root, d))]
+            reldir = os.path.relpath(root, self.target)
+            reldir = "" if reldir == "." else reldir
+            for name in dirs + files:
+                relpath = os.path.join(reldir, name)
+                if relpath not in wanted and not self.protected(relpath):
+                    doomed.append(os.path.join(root, name))
+        # children before their directories
+        for path in reversed(doomed):
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.rmdir(path)  # only empty, kept files stay in place
+                else:
+                    os.unlink(path)
+                self._count("deleted")
+            except OSError:
+                pass
+
+    def replace(self, dst):
+        """ remove whatever is at dst, a directory with its contents, like rsync does """
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            if os.path.ismount(dst):
+                raise OSError(errno.EBUSY, "a filesystem is mounted here", dst)
+            shutil.rmtree(dst)
+        else:
+            os.unlink(dst)
+
+    def copy_entry(self, pool, relpath, st):
+        """ directories, symlinks and hardlinks here, regular file data in the pool """
+        if self.delta and self.protected(relpath):
+            return None  # kept as the installed system has it
+        src = os.path.join(self.source, relpath)
+        dst = os.path.join(self.target, relpath)
+        mode = st.st_mode
+        if stat.S_ISDIR(mode):
+            if os.path.lexists(dst) and (os.path.islink(dst) or not os.path.isdir(dst)):
+                self.replace(dst)
+            os.makedirs(dst, exist_ok=True)
+            self.dirs.append((relpath, st))
+            self._count("dirs")
+        elif stat.S_ISLNK(mode):
+            if self.delta and os.path.islink(dst) and os.readlink(dst) == os.readlink(src):
+                self._count("unchanged")
+                return None
+            if os.path.lexists(dst):
+                self.replace(dst)
+            os.symlink(os.readlink(src), dst)
+            self.copy_metadata(src, dst, st)
+            self._count("symlinks")
+        elif stat.S_ISREG(mode):
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in self.inodes:
+                    self.links.append((self.inodes[key], relpath))
+                    return None
+                self.inodes[key] = relpath
+            if self.delta and self.unchanged(relpath, st):
+                self._count("unchanged")
+                return None
+            # never write through a symlink or into a file hardlinked elsewhere
+            if os.path.islink(dst) or (os.path.lexists(dst) and (self.delta or not os.path.isfile(dst))):
+                self.replace(dst)
+            return pool.submit(self.copy_file, relpath, st)
+        # devices, fifos and sockets are skipped like rsync --no-D does
+
+    def finish(self):
+        """ hardlinks once their first name exists, directory times last """
+        for first, relpath in self.links:
+            dst = os.path.join(self.target, relpath)
+            try:
+                if self.delta and os.path.lexists(dst) and \
+                        os.path.samefile(dst, os.path.join(self.target, first)):
+                    continue
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                os.link(os.path.join(self.target, first), dst)
+                self._count("hardlinks")
+            except OSError as e:
+                err("Cannot link {}: {}".format(relpath, e))
+                self._count("errors")
+        # children first, so setting a parent's mtime is the last change to it
+        for relpath, st in reversed(self.dirs):
+            self.copy_metadata(os.path.join(self.source, relpath),
+                               os.path.join(self.target, relpath), st)
+        while self.written:
+            self._drop(*self.written.popleft())
+
+    def schedule(self, entries):
+        """ the tree (directories, symlinks) first, then file data in on-media order """
+        tree = [e for e in entries if not stat.S_ISREG(e[1].st_mode)]
+        files = [e for e in entries if stat.S_ISREG(e[1].st_mode)]
+        if self.order == "layout" and self.layout:
+            last = len(self.layout)
+            files.sort(key=lambda e: (self.layout.get(e[0], last), e[1].st_ino))
+        elif self.order in ("layout", "inode"):
+            # squashfs numbers inodes in the order mksquashfs packed them
+            files.sort(key=lambda e: e[1].st_ino)
+        return tree + files
+
+    def run(self, entries=None):
+        """ copy entries ((relpath, lstat) as from scan()), everything if None """
+        start = time.monotonic()
+        os.makedirs(self.target, exist_ok=True)
+        if entries is None:
+            entries = list(self.scan())
+        self.entries = entries
+        if self.delta:
+            # first, frees space for the changed files
+            self.prune(entries)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for relpath, st in self.schedule(entries):
+                try:
+                    future = self.copy_entry(pool, relpath, st)
+                except OSError as e:
+                    err("Cannot copy {}: {}".format(relpath, e))
+                    self._count("errors")
+                    continue
+                if future is not None:
+                    pending.append(future)
+                elif self.progress:
+                    self.progress(relpath)
+                # bound the queue, keeps reads close to the schedule
+                while len(pending) > 16 * self.workers:
+                    pending.popleft().result()
+        self.finish()
+        elapsed = time.monotonic() - start
+        self.stats["seconds"] = round(elapsed, 1)
+        self.stats["mb_per_second"] = round(self.stats["bytes"] / 1000000 / elapsed, 1) if elapsed else 0
+        log("Copy finished: {}".format(self.stats))
+        return self.stats
@@ -0,0 +1,187 @@
+import os
+import threading
+import subprocess
+from utils import asynchronous
+from logger import log, err
+
+SYS_BLOCK = "/sys/block"
+LIVE_MEDIUM = "/run/live/medium"
+EXCLUDE_DEVICES = ['/dev/sr0', '/dev/sr1', '/dev/cdrom',
+                   '/dev/dvd', '/dev/fd0', '/dev/nullb0']
+
+
+def _read(path, default=""):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def parent_disk(name):
+    """ sda1 -> sda, nvme0n1p2 -> nvme0n1, using sysfs instead of name patterns """
+    name = os.path.basename(name)
+    sysfs = os.path.join("/sys/class/block", name)
+    if os.path.exists(os.path.join(sysfs, "partition")):
+        return os.path.basename(os.path.dirname(os.path.realpath(sysfs)))
+    return name
+
+
+def partition_path(disk_path, number):
+    """ /dev/sda, 1 -> /dev/sda1; /dev/nvme0n1, /dev/mmcblk0, /dev/loop0 -> ...p1 """
+    return "{}{}{}".format(disk_path, "p" if disk_path[-1].isdigit() else "", number)
+
+
+def mount_source(mountpoint):
+    """ source device of a mountpoint, from /proc/self/mountinfo """
+    try:
+        with open("/proc/self/mountinfo", "r") as f:
+            for line in f:
+                fields = line.split()
+                if fields[4] == mountpoint:
+                    return fields[fields.index("-") + 2]
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def human_size(size):
+    # manufacturer's size for show, e.g. in GB, not GiB!
+    units = [_('B'), _('kB'), _('MB'), _('GB'), _('TB'), 'PB', 'EB', 'ZB', 'YB']
+    unit_index = 0
+    while size >= 1000 and unit_index < len(units) - 1:
+        size /= 1000.0
+        unit_index += 1
+    return "%s %s" % (str(int(size)), units[unit_index])
+
+
+class DeviceInventory:
+    ''' Block devices usable as installation targets, kept up to date from udev events '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.disks = None
+        self.listeners = []
+        self.monitor = None
+        self.paused = False
+
+    def scan(self):
+        """ enumerate whole disks from sysfs """
+        disks = {}
+        exclude = list(EXCLUDE_DEVICES)
+        live_device = mount_source(LIVE_MEDIUM)
+        if live_device and live_device.startswith("/dev/"):
+            live_device = "/dev/" + parent_disk(live_device)
+            exclude.append(live_device)
+            log("Excluding %s (detected as the live device)" % live_device)
+        for name in sorted(os.listdir(SYS_BLOCK)):
+            sysfs = os.path.join(SYS_BLOCK, name)
+            device = "/dev/" + name
+            # loop, ram, zram and dm devices have no backing device,
+            # md arrays are offered like disks
+            raid = os.path.isdir(os.path.join(sysfs, "md"))
+            if device in exclude or name.startswith(("sr", "fd")) or \
+                    not (raid or os.path.exists(os.path.join(sysfs, "device"))):
+                continue
+            # members of an array are not wiped one by one
+            if any(h.startswith("md") for h in _listdir(os.path.join(sysfs, "holders"))):
+                continue
+            size = int(_read(os.path.join(sysfs, "size"), "0")) * 512
+            if size == 0:
+                continue
+            removable = _read(os.path.join(sysfs, "removable"), "0") == "1"
+            if raid:
+                model = "RAID {}".format(_read(os.path.join(sysfs, "md/level"), "")).strip()
+            else:
+                model = _read(os.path.join(sysfs, "device/model")) or name
+            description = '{} ({})'.format(model.strip(), human_size(size))
+            if removable:
+                description = _('Removable:') + ' ' + description
+            disks[device] = {"path": device, "name": name, "size": size,
+                             "removable": removable, "model": model,
+                             "description": description}
+        return disks
+
+    def refresh(self):
+        """ rescan, returns (added, removed) device paths """
+        disks = self.scan()
+        with self.lock:
+            old = self.disks or {}
+            self.disks = disks
+        added = [d for d in disks if d not in old]
+        removed = [d for d in old if d not in disks]
+        return added, removed
+
+    def get_disks(self):
+        """ [(path, description)], non-removable disks first """
+        if self.disks is None:
+            self.refresh()
+        with self.lock:
+            disks = sorted(self.disks.values(),
+                           key=lambda d: (d["removable"], d["name"]))
+        return [(d["path"], d["description"]) for d in disks]
+
+    def get(self, path):
+        if self.disks is None:
+            self.refresh()
+        return self.disks.get(path)
+
+    def subscribe(self, callback):
+        """ callback(event, path) with event in add, remove, change """
+        self.listeners.append(callback)
+        self.start_monitor()
+
+    def notify(self, event, path):
+        if self.paused:
+            return
+        log("Device %s: %s" % (event, path))
+        for callback in self.listeners:
+            try:
+                callback(event, path)
+            except Exception as e:
+                err("Device listener failed: %s" % e)
+
+    def pause(self):
+        """ stop notifying, e.g. while the installer itself is writing partition tables """
+        self.paused = True
+
+    def start_monitor(self):
+        if self.monitor is None:
+            self.monitor = self.watch()
+
+    @asynchronous
+    def watch(self):
+        try:
+            process = subprocess.Popen(["udevadm", "monitor", "--udev", "--subsystem-match=block"],
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            err("Could not watch block devices: %s" % e)
+            return
+        for line in process.stdout:
+            # UDEV  [1234.5678] add      /devices/.../block/sdb/sdb1 (block)
+            fields = line.decode("utf-8", "ignore").split()
+            if len(fields) < 4 or fields[0] != "UDEV" or "/block/" not in fields[3]:
+                continue
+            action, devpath = fields[2], fields[3]
+            parts = devpath.split("/block/", 1)[1].split("/")
+            disk = "/dev/" + parts[0]
+            if len(parts) == 1 and action in ("add", "remove", "change"):
+                # md arrays get their size (and become usable) with a change event
+                added, removed = self.refresh()
+                for path in added:
+                    self.notify("add", path)
+                for path in removed:
+                    self.notify("remove", path)
+                if action == "change" and disk in self.disks and disk not in added:
+                    # partition table rewritten
+                    self.notify("change", disk)
+
+
+inventory = DeviceInventory()
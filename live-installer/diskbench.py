@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+import os
+import sys
+import mmap
+import time
+import random
+import threading
+from logger import log, err
+
+# Short read-only benchmark of the candidate disks. Reads bypass the page
+# cache (O_DIRECT) so repeated runs and the live system do not skew them.
+
+SEQ_BLOCK = 1024 * 1024
+RANDOM_BLOCK = 4096
+SEQ_LIMIT = 512 * 1024 * 1024
+
+_lock = threading.Lock()
+_results = {}
+
+
+def _device_size(fd):
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def sequential_read(fd, size, seconds):
+    """ MB/s of 1 MiB reads from the start of the disk """
+    buf = mmap.mmap(-1, SEQ_BLOCK)
+    offset, start = 0, time.monotonic()
+    limit = min(size, SEQ_LIMIT) - SEQ_BLOCK
+    while offset <= limit and time.monotonic() - start < seconds:
+        if os.preadv(fd, [buf], offset) <= 0:
+            break
+        offset += SEQ_BLOCK
+    elapsed = time.monotonic() - start
+    return offset / elapsed / 1000000 if elapsed else 0
+
+
+def random_read(fd, size, seconds):
+    """ IOPS of 4 KiB reads at random aligned offsets """
+    buf = mmap.mmap(-1, RANDOM_BLOCK)
+    blocks = size // RANDOM_BLOCK
+    count, start = 0, time.monotonic()
+    while time.monotonic() - start < seconds:
+        os.preadv(fd, [buf], random.randrange(blocks) * RANDOM_BLOCK)
+        count += 1
+    elapsed = time.monotonic() - start
+    return count / elapsed if elapsed else 0
+
+
+def benchmark(path, seconds=2):
+    """ {"mbps", "iops"} of path, cached per device """
+    with _lock:
+        if path in _results:
+            return _results[path]
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        err("Could not benchmark {}: {}".format(path, e))
+        return None
+    try:
+        size = _device_size(fd)
+        result = {"mbps": sequential_read(fd, size, seconds),
+                  "iops": random_read(fd, size, seconds)}
+    except OSError as e:
+        err("Could not benchmark {}: {}".format(path, e))
+        return None
+    finally:
+        os.close(fd)
+    log("Disk {}: {:.0f} MB/s sequential, {:.0f} IOPS random".format(
+        path, result["mbps"], result["iops"]))
+    with _lock:
+        _results[path] = result
+    return result
+
+
+def get(path):
+    with _lock:
+        return _results.get(path)
+
+
+def format_result(result):
+    return "{:.0f} MB/s, {:.0f} IOPS".format(result["mbps"], result["iops"])
+
+
+def fastest(paths):
+    """ the path with the best measured sequential read, None if nothing measured """
+    measured = [(get(p)["mbps"], p) for p in paths if get(p)]
+    return max(measured)[1] if measured else None
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        result = benchmark(path)
+        if result:
+            log("{}: {}".format(path, format_result(result)))
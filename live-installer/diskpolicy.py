@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+import os
+import sys
+import config
+import capabilities
+from logger import log, err
+
+# Filesystem and mkfs options for the automated layout, chosen by the kind
+# of disk. Profiles can be replaced per class from config.yaml:
+#
+#   disk_profiles:
+#     ssd:
+#       filesystem: f2fs
+#       mkfs_options: -O extra_attr,inode_checksum,sb_checksum
+
+PROFILES = {
+    "nvme": {"filesystem": "ext4", "mkfs_options": "-O fast_commit"},
+    "ssd": {"filesystem": "ext4", "mkfs_options": "-O fast_commit"},
+    "mmc": {"filesystem": "f2fs", "mkfs_options": "-O extra_attr,inode_checksum,sb_checksum"},
+    "hdd": {"filesystem": "ext4", "mkfs_options": "-i 65536"},
+    "raid": {"filesystem": "ext4", "mkfs_options": ""},
+}
+FALLBACK = {"filesystem": "ext4", "mkfs_options": ""}
+
+# flags which make mkfs overwrite an existing filesystem without asking
+FORCE = {"ext2": "-F", "ext3": "-F", "ext4": "-F", "xfs": "-f", "btrfs": "-f", "f2fs": "-f"}
+
+# root filesystems grub should not load the kernel from, these get an
+# ext4 /boot partition in the automated layout
+SEPARATE_BOOT = ("f2fs",)
+
+_profiles = {}
+
+
+def _read(path, default=""):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def classify(disk_path):
+    """ device class and queue limits of a whole disk, from sysfs """
+    name = os.path.basename(os.path.realpath(disk_path))
+    queue = "/sys/block/{}/queue/".format(name)
+    info = {
+        "rotational": _read(queue + "rotational", "1") == "1",
+        "discard": int(_read(queue + "discard_max_bytes", "0") or 0) > 0,
+        "minimum_io": int(_read(queue + "minimum_io_size", "0") or 0),
+        "optimal_io": int(_read(queue + "optimal_io_size", "0") or 0),
+    }
+    if name.startswith("nvme"):
+        info["class"] = "nvme"
+    elif name.startswith("mmcblk"):
+        info["class"] = "mmc"
+    elif name.startswith("md") or (name.startswith("dm-") and
+                                   info["optimal_io"] > info["minimum_io"] > 0):
+        # striped md arrays and device mapper raid targets, plain disks
+        # also report an optimal io size without being striped
+        info["class"] = "raid"
+    elif info["rotational"]:
+        info["class"] = "hdd"
+    else:
+        info["class"] = "ssd"
+    return info
+
+
+def stripe_options(info, block_size=4096):
+    """ ext4 stride/stripe_width from the queue limits of striped devices """
+    minimum, optimal = info["minimum_io"], info["optimal_io"]
+    if minimum < block_size or optimal <= minimum or optimal % minimum:
+        return ""
+    return "-E stride={},stripe_width={}".format(minimum // block_size, optimal // block_size)
+
+
+def select_profile(disk_path):
+    """ {class, filesystem, mkfs_options, rotational, discard, ...} for disk_path """
+    if disk_path in _profiles:
+        return _profiles[disk_path]
+    info = classify(disk_path)
+    profile = dict(PROFILES.get(info["class"], FALLBACK))
+    profile.update(config.get("disk_profiles", {}).get(info["class"], {}) or {})
+    if not capabilities.host.has_tool("mkfs." + profile["filesystem"]):
+        err("mkfs.{} is not available, using ext4 on {}".format(profile["filesystem"], disk_path))
+        profile = dict(FALLBACK)
+    if info["class"] == "raid" and profile["filesystem"] == "ext4" and not profile["mkfs_options"]:
+        profile["mkfs_options"] = stripe_options(info)
+    profile.update(info)
+    log("Disk profile for {}: {}".format(disk_path, profile))
+    _profiles[disk_path] = profile
+    return profile
+
+
+def needs_boot_partition(disk_path):
+    return select_profile(disk_path)["filesystem"] in SEPARATE_BOOT
+
+
+def mkfs_command(profile, path):
+    filesystem = profile["filesystem"]
+    return " ".join(part for part in ("mkfs." + filesystem, FORCE.get(filesystem, ""),
+                                      str(profile.get("mkfs_options") or ""), path) if part)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        profile = select_profile(path)
+        log("{}: {}".format(path, mkfs_command(profile, path)))
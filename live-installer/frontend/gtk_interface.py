@@ -6,6 +6,9 @@ import frontend.common
 import threading
 import time
 import parted
+import devices
+import diskbench
+import prework
 from utils import *
 from frontend import *
 from frontend.dialogs import QuestionDialog, ErrorDialog, WarningDialog
@@ -38,6 +41,9 @@ class InstallerWindow:
         # build the setup object (where we put all our choices) and the installer
         self.setup = Setup()
         self.installer = InstallerEngine(self.setup)
+        # get ready to copy while the questions are answered
+        self.installer.prework = prework.PreWork(self.installer)
+        self.installer.prework.start()
 
         self.resource_dir = './resources/'
         if config.get("set_alternative_ui", False):
@@ -107,12 +113,13 @@ class InstallerWindow:
         timezones.build_timezones(self)
 
         # type page
-        model = Gtk.ListStore(str, str)
-        model.set_sort_column_id(0, Gtk.SortType.ASCENDING)
-        for disk_path, disk_description in partitioning.get_disks():
-            model.append(
-                ("%s (%s)" % (disk_description, disk_path), disk_path))
-        self.builder.get_object("combo_disk").set_model(model)
+        self.build_disk_list()
+        devices.inventory.subscribe(self.disks_changed)
+        self.benchmark_thread = None
+        # the disk preselected from the benchmark, replaced by faster ones
+        self.benchmark_selection = None
+        if config.get("disk_benchmark", True):
+            self.benchmark_thread = self.benchmark_disks()
         renderer_text = Gtk.CellRendererText()
         self.builder.get_object("combo_disk").pack_start(renderer_text, True)
         self.builder.get_object("combo_disk").add_attribute(
@@ -139,11 +146,15 @@ class InstallerWindow:
         self.builder.get_object("button_edit").connect(
             "clicked", partitioning.manually_edit_partitions)
         self.builder.get_object("button_refresh").connect(
-            "clicked", lambda _: partitioning.build_partitions(self))
+            "clicked", lambda _: partitioning.refresh_partitions(self))
         self.builder.get_object("treeview_disks").connect(
             "row_activated", partitioning.edit_partition_dialog)
         self.builder.get_object("treeview_disks").connect(
             "button-release-event", partitioning.partitions_popup_menu)
+        self.builder.get_object("treeview_disks").connect(
+            "row-expanded", partitioning.disk_row_expanded)
+        self.builder.get_object("treeview_disks").connect(
+            "cursor-changed", partitioning.disk_row_selected)
         text = Gtk.CellRendererText()
         for i in (partitioning.IDX_PART_PATH,
                   partitioning.IDX_PART_TYPE,
@@ -446,6 +457,64 @@ class InstallerWindow:
         else:
             self.builder.get_object("check_confirm").show()
 
+    def build_disk_list(self):
+        combo = self.builder.get_object("combo_disk")
+        selected = None
+        if combo.get_active() > -1:
+            selected = combo.get_model()[combo.get_active()][1]
+        model = Gtk.ListStore(str, str)
+        model.set_sort_column_id(0, Gtk.SortType.ASCENDING)
+        for disk_path, disk_description in partitioning.get_disks():
+            label = "%s (%s)" % (disk_description, disk_path)
+            result = diskbench.get(disk_path)
+            if result:
+                label += " - " + diskbench.format_result(result)
+            itervar = model.append((label, disk_path))
+            if disk_path == selected:
+                selected = itervar
+        combo.set_model(model)
+        if isinstance(selected, Gtk.TreeIter):
+            combo.set_active_iter(selected)
+
+    @idle
+    def disks_changed(self, event, disk_path):
+        if event in ("add", "remove"):
+            self.build_disk_list()
+        if event == "add" and config.get("disk_benchmark", True) and \
+                not (self.benchmark_thread and self.benchmark_thread.is_alive()):
+            self.benchmark_thread = self.benchmark_disks()
+
+    @asynchronous
+    def benchmark_disks(self):
+        """ measure the candidate disks one after the other, in the background """
+        seconds = config.get("disk_benchmark_seconds", 2)
+        done = set()
+        while True:
+            pending = [d for d, desc in partitioning.get_disks() if d not in done]
+            if not pending:
+                break
+            done.add(pending[0])
+            if diskbench.benchmark(pending[0], seconds):
+                self.disk_benchmarked()
+
+    @idle
+    def disk_benchmarked(self):
+        self.build_disk_list()
+        combo = self.builder.get_object("combo_disk")
+        if not self.setup.automated:
+            return
+        if combo.get_active() > -1 and \
+                combo.get_model()[combo.get_active()][1] != self.benchmark_selection:
+            return  # chosen by the user
+        # preselect the fastest fixed disk measured so far, the user can still change it
+        fixed = [d for d, desc in partitioning.get_disks()
+                 if devices.inventory.get(d) and not devices.inventory.get(d)["removable"]]
+        fastest = diskbench.fastest(fixed)
+        for row in combo.get_model():
+            if row[1] == fastest:
+                self.benchmark_selection = fastest
+                combo.set_active_iter(row.iter)
+
     def assign_type_options(self, widget, data=None):
         self.setup.automated = self.builder.get_object(
             "radio_automated").get_active()
@@ -745,7 +814,7 @@ class InstallerWindow:
             self.setup.keyboard_layout, self.setup.keyboard_variant)
         os.system(command)
 
-    def activate_page(self, nex=0, index=0, goback=False):
+    def activate_page(self, nex=0, index=0, goback=False, probed=False):
         errorFound = False
         self.show_overview()
         if index == self.PAGE_LANGUAGE:
@@ -866,6 +935,16 @@ class InstallerWindow:
         elif index == self.PAGE_PARTITIONS:
             if not goback:
                 model = self.builder.get_object("treeview_disks").get_model()
+                if model and not probed:
+                    # checked again once the partitions are probed, without
+                    # blocking the main loop meanwhile
+                    self.window.set_sensitive(False)
+
+                    def probes_finished():
+                        self.window.set_sensitive(True)
+                        self.activate_page(nex, index, goback, probed=True)
+                    model.when_probed(probes_finished)
+                    return
 
                 # Check for root partition
                 found_root_partition = False
@@ -915,6 +994,11 @@ class InstallerWindow:
                             "An EFI system partition is needed with the following requirements:\n\n - Mount point: /boot/efi\n - Partition flags: Bootable\n - Size: at least 35MB (100MB or more recommended)\n - Format: vfat or fat32\n\nTo ensure compatibility with Windows we recommend you use the first partition of the disk as the EFI system partition.\n "))
                         return
 
+                if config.get("pipelined_install", False):
+                    if not QuestionDialog(_("Warning"), _("The selected partitions will be formatted and the files copied now. Are you sure?")):
+                        return
+                    self.commit_target()
+
         elif index == self.PAGE_OVERVIEW:
             self.show_overview()
         elif index == self.PAGE_INSTALL:
@@ -923,6 +1007,8 @@ class InstallerWindow:
             if not config.get("set_alternative_ui", False):
                 self.builder.get_object("button_quit").set_sensitive(False)
             self.window.resize(0, 0)
+            # from now on the installer itself changes the disks
+            devices.inventory.pause()
             self.do_install()
         if errorFound:
             return
@@ -965,18 +1051,34 @@ class InstallerWindow:
                 WarningDialog(_("Installer"), errorMessage)
             else:
                 if QuestionDialog(_("Warning"), _("This will delete all the data on %s. Are you sure?") % self.setup.diskname):
-                    partitioning.build_partitions(self)
+                    partitioning.build_partitions(self, wiped=self.setup.disk)
                     partitioning.build_grub_partitions()
+                    if config.get("pipelined_install", False):
+                        self.commit_target()
                     self.activate_page(self.PAGE_OVERVIEW)
         else:
             self.activate_page(self.PAGE_PARTITIONS)
             partitioning.build_partitions(self)
             partitioning.build_grub_partitions()
 
+    def commit_target(self):
+        ''' pipelined mode: format and copy while the remaining pages are answered '''
+        if self.installer.copy_thread is not None:
+            return
+        self.installer.set_progress_hook(self.update_progress)
+        self.installer.set_error_hook(self.error_message)
+        self.critical_error_happened = False
+        # from now on the installer itself changes the disks
+        devices.inventory.pause()
+        self.installer.start_copy()
+        self.builder.get_object("button_back").set_sensitive(False)
+
     def wizard_cb(self, widget, goback, data=None):
         ''' wizard buttons '''
         sel = self.builder.get_object("notebook1").get_current_page()
-        self.builder.get_object("button_back").set_sensitive(True)
+        # the target can not be changed once it is being written
+        self.builder.get_object("button_back").set_sensitive(
+            self.installer.copy_thread is None)
         nex = None
         # check each page for errors
         if(not goback):
@@ -1117,7 +1219,8 @@ class InstallerWindow:
         self.installer.set_error_hook(self.error_message)
 
         # do we dare? ..
-        self.critical_error_happened = False
+        if self.installer.copy_thread is None:
+            self.critical_error_happened = False
 
         # Start installing
         do_try_finish_install = True
@@ -1,6 +1,13 @@
 # coding: utf-8
 #
 import parted
+import devices
+import capabilities
+import diskpolicy
+import tempfile
+import probecache
+import superblock
+from concurrent.futures import ThreadPoolExecutor, wait
 from frontend import *
 
 gettext.install("live-installer", "/usr/share/locale")
@@ -20,6 +27,7 @@ gettext.install("live-installer", "/usr/share/locale")
 
 
 TMP_MOUNTPOINT = '/tmp/live-installer/tmpmount'
+PROBE_TIMEOUT = 15  # seconds per mount/umount while probing partitions
 RESOURCE_DIR = './resources/'
 
 EFI_MOUNT_POINT = '/boot/efi'
@@ -27,52 +35,16 @@ SWAP_MOUNT_POINT = 'swap'
 
 
 def get_disks():
-    disks = []
-    exclude_devices = ['/dev/sr0', '/dev/sr1',
-                       '/dev/cdrom', '/dev/dvd', '/dev/fd0', '/dev/nullb0']
-    live_device = subprocess.getoutput(
-        "findmnt -n -o source /run/live/medium").split('\n')[0]
-    # remove partition numbers if any
-    live_device = re.sub('[0-9]+$', '', live_device)
-    if live_device is not None and live_device.startswith('/dev/'):
-        exclude_devices.append(live_device)
-        log("Excluding %s (detected as the live device)" % live_device)
-    lsblk = shell_exec(
-        'LC_ALL=en_US.UTF-8 lsblk -rindo TYPE,NAME,RM,SIZE,MODEL | sort -k3,2')
-    for line in lsblk.stdout:
-        try:
-            elements = str(line).strip().split(" ")
-            if len(elements) < 4:
-                log("Can't parse blkid output: %s" % elements)
-                continue
-            elif len(elements) < 5:
-                log("Can't find model in blkid output: %s" % elements)
-                typevar, device, removable, size, model = elements[
-                    0], elements[1], elements[2], elements[3], elements[1]
-            else:
-                typevar, device, removable, size, model = elements
-            device = "/dev/" + device
-            if str(typevar) == "b'disk" and device not in exclude_devices:
-                # convert size to manufacturer's size for show, e.g. in GB, not GiB!
-                unit_index = 'BKMGTPEZY'.index(size.upper()[-1])
-                l10n_unit = [_('B'), _('kB'), _('MB'), _('GB'), _(
-                    'TB'), 'PB', 'EB', 'ZB', 'YB'][unit_index]
-                size = "%s %s" % (
-                    str(int(float(size[:-1]) * (1024/1000)**unit_index)), l10n_unit)
-                model = model.replace("\\x20", " ")
-                description = ('{} ({})'.format(
-                    model.strip(), size)).replace("\\n'", "")
-                if int(removable):
-                    description = _('Removable:') + ' ' + description
-                disks.append((device, description))
-        except Exception as detail:
-            log("Could not parse blkid output: %s (%s)" % (line, detail))
-    return disks
+    return devices.inventory.get_disks()
 
 
-def build_partitions(_installer):
+def build_partitions(_installer, wiped=None):
+    """ wiped: the disk an automated install formats, its partitions are not probed """
     global installer
     installer = _installer
+    wiped_disks.clear()
+    if wiped:
+        release_disk(wiped)
     installer.window.get_window().set_cursor(
         Gdk.Cursor.new(Gdk.CursorType.WATCH))  # "busy" cursor
     installer.window.set_sensitive(False)
@@ -82,12 +54,47 @@ def build_partitions(_installer):
     if partition_setup.disks:
         installer._selected_disk = partition_setup.disks[0][0]
     log("Showing the partition screen")
-    installer.builder.get_object("treeview_disks").set_model(partition_setup)
-    installer.builder.get_object("treeview_disks").expand_all()
+    treeview = installer.builder.get_object("treeview_disks")
+    treeview.set_model(partition_setup)
+    if partition_setup.disks:
+        # show the first disk, fetch a few more in the background
+        partition_setup.load_disk(partition_setup.disks[0][0])
+        treeview.expand_row(Gtk.TreePath.new_first(), False)
+        partition_setup.prefetch(config.get("partition_prefetch_disks", 2))
+    if device_changed not in devices.inventory.listeners:
+        devices.inventory.subscribe(device_changed)
     installer.window.get_window().set_cursor(None)
     installer.window.set_sensitive(True)
 
 
+def refresh_partitions(_installer):
+    """ the refresh button: probe everything again """
+    probecache.invalidate()
+    build_partitions(_installer)
+
+
+@idle
+def device_changed(event, disk_path):
+    """ keep the disk list in sync with hotplug and partition table changes """
+    partition_setup = installer.setup.partition_setup
+    if event == "add":
+        partition_setup.add_disk(disk_path, devices.inventory.get(disk_path)["description"])
+    elif event == "remove":
+        partition_setup.remove_disk(disk_path)
+    elif event == "change":
+        partition_setup.reload_disk(disk_path)
+
+
+def disk_row_expanded(treeview, itervar, path):
+    treeview.get_model().load_disk(treeview.get_model()[itervar][IDX_PART_DISK])
+
+
+def disk_row_selected(treeview):
+    model, itervar = treeview.get_selection().get_selected()
+    if itervar and model.iter_parent(itervar) is None:
+        model.load_disk(model[itervar][IDX_PART_DISK])
+
+
 def edit_partition_dialog(widget, path, viewcol):
     ''' assign the partition ... '''
     model, itervar = installer.builder.get_object(
@@ -96,6 +103,8 @@ def edit_partition_dialog(widget, path, viewcol):
         return
     row = model[itervar]
     partition = row[IDX_PART_OBJECT]
+    if partition is None:
+        return  # disk row
     if (partition.partition.type != parted.PARTITION_EXTENDED and
             partition.partition.number != -1):
         dlg = PartitionDialog(row[IDX_PART_PATH],
@@ -202,6 +211,27 @@ def build_grub_partitions():
     installer.builder.get_object("combobox_grub").set_active(0)
 
 
+# partitions are probed concurrently, rows are updated as results arrive
+probe_pool = ThreadPoolExecutor(
+    max_workers=config.get("partition_probe_workers", 8))
+# (disk path, future) of every probe, probes mount the partitions they look at
+probes = []
+# disks which are about to be formatted, their partitions are not probed
+wiped_disks = set()
+
+
+def release_disk(disk_path):
+    """ stop probing disk_path, returns its probes which are still running """
+    wiped_disks.add(disk_path)
+    return [future for path, future in probes
+            if path == disk_path and not future.cancel() and not future.done()]
+
+
+def wait_for_disk(disk_path):
+    """ from the installer, before disk_path is formatted (bounded by the probe timeout) """
+    wait(release_disk(disk_path), timeout=2 * config.get("partition_probe_timeout", PROBE_TIMEOUT))
+
+
 class PartitionSetup(Gtk.TreeStore):
     def __init__(self):
         super(PartitionSetup, self).__init__(str,  # path
@@ -216,81 +246,207 @@ class PartitionSetup(Gtk.TreeStore):
         installer.setup.partitions = []
         installer.setup.partition_setup = self
 
-        os.popen('mkdir -p ' + TMP_MOUNTPOINT)
+        os.makedirs(TMP_MOUNTPOINT, exist_ok=True)
         self.disks = get_disks()
         log('Disks: ', self.disks)
-        already_done_full_disk_format = False
-        for disk_path, disk_description in self.disks:
-            log("    Analyzing path='%s' description='%s'" %
-                (disk_path, disk_description))
-            disk_device = parted.getDevice(disk_path)
+        self.full_disk_formatted = False
+        # only disk rows are built up front, partitions on demand
+        self.disk_iters = {}
+        self.loaded_disks = set()
+        for disk_path, disk_description in list(self.disks):
+            self.add_disk(disk_path, disk_description)
+
+    def add_disk(self, disk_path, disk_description):
+        if disk_path in self.disk_iters:
+            return
+        if (disk_path, disk_description) not in self.disks:
+            self.disks.append((disk_path, disk_description))
+        disk_iter = self.append(
+            None, (disk_description, '', '', '', '', '', '', None, disk_path))
+        # placeholder child, makes the row expandable
+        self.append(disk_iter, ('', '', _('Loading...'),
+                                '', '', '', '', None, disk_path))
+        self.disk_iters[disk_path] = disk_iter
+
+    def forget_partitions(self, disk_path):
+        """ drop the partitions of disk_path from the setup, returns their assignments """
+        assigned = {}
+        for partition in [p for p in installer.setup.partitions
+                          if p.partition.disk.device.path == disk_path]:
+            if partition.mount_as or partition.format_as:
+                assigned[(partition.name, partition.partition.geometry.start)] = \
+                    (partition.mount_as, partition.format_as)
+            installer.setup.partitions.remove(partition)
+        self.loaded_disks.discard(disk_path)
+        return assigned
+
+    def remove_disk(self, disk_path):
+        if disk_path not in self.disk_iters:
+            return
+        self.forget_partitions(disk_path)
+        self.remove(self.disk_iters.pop(disk_path))
+        self.disks = [d for d in self.disks if d[0] != disk_path]
+        if installer._selected_disk == disk_path:
+            installer._selected_disk = self.disks[0][0] if self.disks else None
+
+    def reload_disk(self, disk_path):
+        """ re-read a partition table that changed behind our back (e.g. gparted) """
+        probecache.invalidate(disk_path)
+        if disk_path not in self.loaded_disks:
+            return  # still shows the placeholder, read on expansion anyway
+        disk_iter = self.disk_iters[disk_path]
+        assigned = self.forget_partitions(disk_path)
+        treeview = installer.builder.get_object("treeview_disks")
+        expanded = treeview.row_expanded(self.get_path(disk_iter))
+        children = []
+        child = self.iter_children(disk_iter)
+        while child is not None:
+            children.append(child)
+            child = self.iter_next(child)
+        self.append(disk_iter, ('', '', _('Loading...'),
+                                '', '', '', '', None, disk_path))
+        for child in children:
+            self.remove(child)
+        # keep mount points of partitions which did not move
+        self.load_disk(disk_path, assigned)
+        if expanded:
+            treeview.expand_row(self.get_path(disk_iter), False)
+
+    def load_disk(self, disk_path, assigned=None):
+        """ read the partition table of disk_path and start probing its partitions """
+        if disk_path in self.loaded_disks or disk_path not in self.disk_iters:
+            return
+        self.loaded_disks.add(disk_path)
+        disk_iter = self.disk_iters[disk_path]
+        disk_description = self.get_value(disk_iter, IDX_PART_PATH)
+        log("    Analyzing path='%s' description='%s'" %
+            (disk_path, disk_description))
+        # the placeholder is dropped after the partitions were added,
+        # so an expanded row does not collapse meanwhile
+        placeholder = self.iter_children(disk_iter)
+        try:
+            self.add_disk_partitions(disk_path, disk_iter, disk_description, assigned)
+        finally:
+            if placeholder is not None:
+                self.remove(placeholder)
+
+    def add_disk_partitions(self, disk_path, disk_iter, disk_description, assigned=None):
+        assign_mount_format = None
+        disk_device = parted.getDevice(disk_path)
+        try:
+            disk = parted.Disk(disk_device)
+        except Exception as detail:
+            log("Found an issue while looking for the disk: %s" % detail)
+            from frontend.gtk_interface import QuestionDialog
+            dialog = QuestionDialog(_("Installation Tool"),
+                                    _("No partition table was found on the hard drive: %s. Do you want the installer to create a set of partitions for you? Note: This will ERASE ALL DATA present on this disk.") % disk_description,
+                                    None, installer.window)
+            if not dialog:
+                return  # the user said No, skip this disk
             try:
+                installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+                create_boot = diskpolicy.needs_boot_partition(disk_device.path)
+                if not self.full_disk_formatted:
+                    assign_mount_format = full_disk_format(disk_device, create_boot)
+                    self.full_disk_formatted = True
+                else:
+                    # Format but don't assign mount points
+                    full_disk_format(disk_device, create_boot)
+                installer.window.get_window().set_cursor(None)
                 disk = parted.Disk(disk_device)
-            except Exception as detail:
-                log("Found an issue while looking for the disk: %s" % detail)
-                from frontend.gtk_interface import QuestionDialog
-                dialog = QuestionDialog(_("Installation Tool"),
-                                        _("No partition table was found on the hard drive: %s. Do you want the installer to create a set of partitions for you? Note: This will ERASE ALL DATA present on this disk.") % disk_description,
-                                        None, installer.window)
-                if not dialog:
-                    continue  # the user said No, skip this disk
-                try:
-                    installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
-                    if not already_done_full_disk_format:
-                        assign_mount_format = full_disk_format(disk_device)
-                        already_done_full_disk_format = True
-                    else:
-                        # Format but don't assign mount points
-                        full_disk_format(disk_device)
-                    installer.window.get_window().set_cursor(None)
-                    disk = parted.Disk(disk_device)
-                except Exception:
-                    installer.window.get_window().set_cursor(None)
-                    continue  # Something is wrong with this disk, skip it
-
-            disk_iter = self.append(
-                None, (disk_description, '', '', '', '', '', '', None, disk_path))
-            free_space_partition = disk.getFreeSpacePartitions()
-            primary_partitions = disk.getPrimaryPartitions()
-            logical_partitions = disk.getLogicalPartitions()
-            raid_partitions = disk.getRaidPartitions()
-            lvm_partitions = disk.getLVMPartitions()
-            partition_set = tuple(free_space_partition + primary_partitions +
-                                  logical_partitions + raid_partitions + lvm_partitions)
-            partitions = []
-            for partition in partition_set:
-                part = Partition(partition)
-                log("{} {}".format(partition.path.replace("-", ""), part.size))
-                # skip ranges <5MB
-                if part.raw_size > 5242880:
-                    partitions.append(part)
-            partitions = sorted(
-                partitions, key=lambda part: part.partition.geometry.start)
-
-            try:  # assign mount_as and format_as if disk was just auto-formatted
-                for partition, (mount_as, format_as) in zip(partitions, assign_mount_format):
-                    partition.mount_as = mount_as
-                    partition.format_as = format_as
-                del assign_mount_format
-            except NameError:
-                pass
-            # Needed to fix the 1% minimum Partition.size_percent
-            # .5 for good measure
-            sum_size_percent = sum(p.size_percent for p in partitions) + .5
+            except Exception:
+                installer.window.get_window().set_cursor(None)
+                return  # Something is wrong with this disk, skip it
+
+        free_space_partition = disk.getFreeSpacePartitions()
+        primary_partitions = disk.getPrimaryPartitions()
+        logical_partitions = disk.getLogicalPartitions()
+        raid_partitions = disk.getRaidPartitions()
+        lvm_partitions = disk.getLVMPartitions()
+        partition_set = tuple(free_space_partition + primary_partitions +
+                              logical_partitions + raid_partitions + lvm_partitions)
+        partitions = []
+        for partition in partition_set:
+            part = Partition(partition)
+            log("{} {}".format(partition.path.replace("-", ""), part.size))
+            # skip ranges <5MB
+            if part.raw_size > 5242880:
+                partitions.append(part)
+        partitions = sorted(
+            partitions, key=lambda part: part.partition.geometry.start)
+
+        if assign_mount_format:  # assign mount_as and format_as if disk was just auto-formatted
+            for partition, (mount_as, format_as) in zip(partitions, assign_mount_format):
+                partition.mount_as = mount_as
+                partition.format_as = format_as
+        elif assigned:
             for partition in partitions:
-                partition.size_percent = round(
-                    partition.size_percent / sum_size_percent * 100, 1)
-                installer.setup.partitions.append(partition)
-                self.append(disk_iter, (partition.name,
-                                        '<span>{}</span>'.format(
-                                            partition.type),
-                                        partition.description,
-                                        partition.format_as,
-                                        partition.mount_as,
-                                        partition.size,
-                                        partition.free_space,
-                                        partition,
-                                        disk_path))
+                key = (partition.name, partition.partition.geometry.start)
+                if key in assigned:
+                    partition.mount_as, partition.format_as = assigned[key]
+        # Needed to fix the 1% minimum Partition.size_percent
+        # .5 for good measure
+        sum_size_percent = sum(p.size_percent for p in partitions) + .5
+        for partition in partitions:
+            partition.size_percent = round(
+                partition.size_percent / sum_size_percent * 100, 1)
+            installer.setup.partitions.append(partition)
+            itervar = self.append(disk_iter, (partition.name,
+                                              '<span>{}</span>'.format(
+                                                  partition.type),
+                                              partition.description,
+                                              partition.format_as,
+                                              partition.mount_as,
+                                              partition.size,
+                                              partition.free_space,
+                                              partition,
+                                              disk_path))
+            self.probe(partition, itervar)
+
+    def prefetch(self, count):
+        """ load the next unloaded disks from the main loop, one per idle cycle """
+        pending = [d for d, desc in self.disks if d not in self.loaded_disks][:count]
+
+        def load_next():
+            while pending:
+                disk_path = pending.pop(0)
+                if disk_path not in self.loaded_disks:
+                    self.load_disk(disk_path)
+                    return bool(pending)
+            return False
+        GLib.idle_add(load_next)
+
+    def probe(self, partition, itervar):
+        if partition.partition.number == -1:
+            return  # free space
+        disk_path = partition.partition.disk.device.path
+        if disk_path in wiped_disks:
+            return
+        future = probe_pool.submit(partition.probe)
+        future.add_done_callback(
+            lambda f: self.update_partition_row(itervar, partition))
+        probes.append((disk_path, future))
+
+    @idle
+    def update_partition_row(self, itervar, partition):
+        if not self.iter_is_valid(itervar):
+            return
+        self.set(itervar, {IDX_PART_DESCRIPTION: partition.description,
+                           IDX_PART_MOUNT_AS: partition.mount_as,
+                           IDX_PART_SIZE: partition.size,
+                           IDX_PART_FREE_SPACE: partition.free_space})
+
+    def when_probed(self, callback):
+        """ callback() from the main loop once the pending probes finished (bounded by the probe timeout) """
+        deadline = time.monotonic() + 2 * config.get("partition_probe_timeout", PROBE_TIMEOUT)
+
+        def check():
+            if time.monotonic() < deadline and not all(f.done() for d, f in probes):
+                return True
+            callback()
+            return False
+        if check():
+            GLib.timeout_add(100, check)
 
 
 @idle
@@ -299,78 +455,101 @@ def show_error(message):
     ErrorDialog(_("Installer"), message)
 
 
-def full_disk_format(device, create_boot=False, create_swap=False):
+def full_disk_format(device, create_boot=False, create_swap=False, image_size=0):
     # Create a default partition set up
     disk_label = ('gpt' if device.getLength('B') > 2**32*.9 * device.sectorSize  # size of disk > ~2TB
                   or is_efi_supported()
                   else 'msdos')
     # Force lazy umount
     os.system("umount -lf {}*".format(device.path))
-    # Wipe first 512 byte
-    open(device.path, "w").write("\x00"*512)
-    return_code = os.system("parted -s %s mklabel %s" %
-                            (device.path, disk_label))
-    if return_code != 0:
-        show_error(
-            _("The partition table couldn't be written for %s. Restart the computer and try again.") % device.path)
-        Gtk.main_quit()
-        sys.exit(1)
 
+    profile = diskpolicy.select_profile(device.path)
     mkpart = (
-        # (condition, mount_as, format_as, mkfs command, size_mb)
+        # (condition, mount_as, format_as, mkfs command, size_mb, sfdisk type)
         # EFI
         (is_efi_supported(), EFI_MOUNT_POINT,
-         'vfat', 'mkfs.vfat {} -F 32 ', 300),
+         'vfat', 'mkfs.vfat {} -F 32 ', 300, 'U'),
         # boot
-        (create_boot, '/boot', 'ext4', 'mkfs.ext4 -F {}', 1024),
+        (create_boot, '/boot', 'ext4', 'mkfs.ext4 -F {}', 1024, 'L'),
         # swap - equal to RAM for hibernate to work well (but capped at ~8GB)
         (create_swap, SWAP_MOUNT_POINT, 'swap', 'mkswap {}', min(8800, int(round(
-            1.1/1024 * int(getoutput("awk '/^MemTotal/{ print $2 }' /proc/meminfo")), -2)))),
+            1.1/1024 * capabilities.host.mem_total_kb, -2))), 'S'),
+        # read-only system image, written as it is by the installer
+        (image_size > 0, None, 'squashfs', '', image_size, 'L'),
         # root
-        (True, '/', 'ext4', 'mkfs.ext4 -F {}', 0),
+        (True, '/', profile["filesystem"], diskpolicy.mkfs_command(profile, '{}'), 0, 'L'),
     )
-    def run_parted(cmd): return os.system(
-        'parted --script --align optimal {} {} ; sync'.format(device.path, cmd))
-    start_mb = 2
-    partition_number = 0
-    partition_prefix = ""
-    if device.path.startswith("/dev/nvme"):
-        partition_prefix = "p"
-    for partition in mkpart:
+    # The whole table is planned here and written by a single sfdisk call:
+    # 1 MiB aligned, the last partition takes the rest of the disk.
+    mib = 1024 * 1024 // device.sectorSize
+    script = ["label: {}".format("gpt" if disk_label == "gpt" else "dos")]
+    partitions = []
+    start = mib
+    for partition in (p for p in mkpart if p[0]):
         log(partition)
-        if partition[0]:
-            partition_number = partition_number + 1
-            mkfs = partition[3]
-            size_mb = partition[4]
-            end = '{}MB'.format(start_mb + size_mb) if size_mb else '100%'
-            mkpart_cmd = 'mkpart primary {}MB {}'.format(start_mb, end)
-            log("Executing: "+mkpart_cmd)
-            run_parted(mkpart_cmd)
-            partition_path = "%s%s%d" % (
-                device.path, partition_prefix, partition_number)
-            num_tries = 0
-            while True:
-                if os.path.exists(partition_path):
-                    break
-                if num_tries < 5:
-                    num_tries += 1
-                    err(("Could not find %s, waiting 1s..." % partition_path))
-                    os.system("sync")
-                    time.sleep(1)
-                else:
-                    show_error(
-                        _("The partition %s could not be created. The installation will stop. Restart the computer and try again.") % partition_path)
-                    Gtk.main_quit()
-                    sys.exit(1)
-            mkfs = mkfs.format(partition_path)
-            log("Executing: "+mkfs)
-            os.system(mkfs)
-            start_mb += size_mb + 1
-    if is_efi_supported():
-        run_parted('set 1 boot on')
+        size_mb, typevar = partition[4], partition[5]
+        line = "start={}, type={}".format(start, typevar)
+        if size_mb:
+            line += ", size={}".format(size_mb * mib)
+            start += size_mb * mib
+        if typevar == 'U' and disk_label != "gpt":
+            line += ", bootable"
+        script.append(line)
+        partitions.append((devices.partition_path(device.path, len(partitions) + 1),
+                           partition[3]))
+    script = "\n".join(script) + "\n"
+    log("Executing: sfdisk {}\n{}".format(device.path, script))
+    result = subprocess.run(["sfdisk", "--wipe", "always", "--wipe-partitions", "always",
+                             device.path], input=script.encode(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        err(result.stderr.decode("utf-8", "ignore"))
+        show_error(
+            _("The partition table couldn't be written for %s. Restart the computer and try again.") % device.path)
+        Gtk.main_quit()
+        sys.exit(1)
+    probecache.invalidate(device.path)
+
+    for partition_path, mkfs in partitions:
+        # returns as soon as udev created the node, no fixed sleeps
+        if not os.path.exists(partition_path):
+            subprocess.call(["udevadm", "settle", "--timeout=10",
+                             "--exit-if-exists=" + partition_path])
+        if not os.path.exists(partition_path):
+            show_error(
+                _("The partition %s could not be created. The installation will stop. Restart the computer and try again.") % partition_path)
+            Gtk.main_quit()
+            sys.exit(1)
+        if not mkfs:
+            continue
+        mkfs = mkfs.format(partition_path)
+        log("Executing: "+mkfs)
+        os.system(mkfs)
     return ((i[1], i[2]) for i in mkpart if i[0])
 
 
+def run_timeout(cmd, timeout):
+    """ returncode of cmd, or None if it did not finish in time (hung mounts are left behind) """
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        return None
+
+
+def read_shell_var(path, name):
+    """ value of NAME=value in a shell style file without sourcing it """
+    try:
+        with open(path, "r", errors="ignore") as f:
+            for line in f:
+                if line.startswith(name + "="):
+                    return line.split("=", 1)[1].strip().strip('"\'')
+    except OSError:
+        pass
+    return ''
+
+
 def to_human_readable(size):
     for unit in [' ', _('kB'), _('MB'), _('GB'), _('TB'), 'PB', 'EB', 'ZB', 'YB']:
         if size < 1000:
@@ -390,6 +569,7 @@ class Partition(object):
 
         self.partition = partition
         self.length = partition.getLength()
+        self.start = partition.geometry.start
         self.size_percent = max(
             1, round(80*self.length/partition.disk.device.getLength(), 1))
         self.size = to_human_readable(partition.getLength('B'))
@@ -423,74 +603,132 @@ class Partition(object):
             }.get(partition.type, '')
         if "swap" in self.type:
             self.mount_as = SWAP_MOUNT_POINT
-
-        # identify partition's description and used space
         try:
-            os.system('mount --read-only {} {}'.format(self.path, TMP_MOUNTPOINT))
-            size, free, self.used_percent, mount_point = str(getoutput(
-                "df {0} | grep '^{0}' | awk '{{print $2,$4,$5,$6}}' | tail -1".format(self.path)).split(None, 3))
-            self.raw_size = int(size)*1024
-            log("                  . size %s, free %s, self.used_percent %s, mount_point %s" % (
-                size, free, self.used_percent, mount_point))
-        except ValueError:
-            if "swap" in self.type:
-                self.os_fs_info, self.description, self.free_space, self.used_percent = ': ' + \
-                    self.type, 'swap', '', 0
-            else:
-                self.os_fs_info, self.description, self.free_space, self.used_percent = ': ' + \
-                    self.type, '', '', 0
-        else:
-            # for mountable partitions, more accurate than the getLength size above
-            self.size = to_human_readable(int(size)*1024)
-            # df returns values in 1024B-blocks by default
-            self.free_space = to_human_readable(int(free)*1024)
-            self.used_percent = self.used_percent.strip(b'%') or 0
-            description = ''
-            if path_exists(str(mount_point), str('etc/linuxmint/info')):
-                description = getoutput("cat %s/etc/linuxmint/info | grep GRUB_TITLE" % mount_point).replace(
-                    'GRUB_TITLE', '').replace('=', '').replace('"', '').strip()
-            elif path_exists(str(mount_point), str('Windows/servicing/Version')):
-                description = 'Windows ' + {
-                    '6.4': '10',
-                    '6.3': '8.1',
-                    '6.2': '8',
-                    '6.1': '7',
-                    '6.0': 'Vista',
-                    '5.2': 'XP Pro x64',
-                    '5.1': 'XP',
-                    '5.0': '2000',
-                    '4.9': 'ME',
-                    '4.1': '98',
-                    '4.0': '95',
-                }.get(getoutput('ls {}/Windows/servicing/Version'.format(mount_point))[:3], '')
-            elif path_exists(mount_point, 'Boot/BCD'):
-                description = 'Windows bootloader/recovery'
-            elif path_exists(mount_point, 'Windows/System32'):
-                description = 'Windows'
-            elif path_exists(mount_point, 'System/Library/CoreServices/SystemVersion.plist'):
-                description = 'Mac OS X'
-            elif path_exists(mount_point, 'etc/'):
-                description = getoutput("su -c '{{ . {0}/etc/lsb-release && echo $DISTRIB_DESCRIPTION; }} || \
-                                                {{ . {0}/etc/os-release && echo $PRETTY_NAME; }}' mint".format(mount_point)) or 'Unix'
-            else:
-                try:
-                    if partition.active:
-                        for flag in partition.getFlagsAsString().split(", "):
-                            if flag in ["boot", "esp"]:
-                                description = 'EFI System Partition'
-                                self.mount_as = EFI_MOUNT_POINT
-                                break
-                except Exception as detail:
-                    # best effort
-                    err("Could not read partition flags for %s: %s" %
-                        (self.path, detail))
-            self.description = description
+            self.flags = partition.getFlagsAsString().split(", ") if partition.active else []
+        except Exception as detail:
+            # best effort
+            err("Could not read partition flags for %s: %s" %
+                (self.path, detail))
+            self.flags = []
+
+        # filled in by probe()
+        self.description = 'swap' if "swap" in self.type else ''
+        self.free_space = ''
+        self.used_percent = 0
+        self.os_fs_info = ': ' + self.type
+        self.efi = False
+
+    def probe(self, timeout=None):
+        """ identify partition's description and used space (runs in probe_pool) """
+        info = superblock.probe(self.path)
+        key = probecache.identity(self.path, self.start, self.length,
+                                  info["uuid"] if info else None)
+        cached = probecache.lookup(key)
+        if cached:
+            log("                  . %s unchanged, using cached probe" % self.path)
+            for field in probecache.FIELDS:
+                if field in cached:
+                    setattr(self, field, cached[field])
+            if self.efi:
+                self.mount_as = EFI_MOUNT_POINT
+            return self
+        if self.probe_filesystem(info, timeout):
+            probecache.store(key, self.__dict__)
+        return self
+
+    def set_usage(self, size, free, used):
+        if size == 0:
+            return
+        self.used_percent = int(math.ceil(100.0 * used / (used + free))) if used + free else 0
+        log("                  . size %s, free %s, self.used_percent %s" % (
+            size, free, self.used_percent))
+        # more accurate than the getLength size above
+        self.raw_size = size
+        self.size = to_human_readable(size)
+        self.free_space = to_human_readable(free)
+
+    def probe_filesystem(self, info, timeout=None):
+        """ read usage from the superblock, mount read-only only to look for an OS.
+            False if the probe did not complete """
+        if info and "free" in info:
+            self.set_usage(info["size"], info["free"], info["used"])
+        if info and info["type"] == "swap":
+            return True
+        timeout = timeout or config.get("partition_probe_timeout", PROBE_TIMEOUT)
+        mount_point = tempfile.mkdtemp(dir=TMP_MOUNTPOINT)
+        mounted = False
+        returncode = 0
+        # never replay journals or logs while probing
+        options = {
+            "ext3": "ro,noload",
+            "ext4": "ro,noload",
+            "xfs": "ro,norecovery",
+            "btrfs": "ro,rescue=nologreplay",
+        }.get(info["type"] if info else None, "ro")
+        try:
+            returncode = run_timeout(
+                ['mount', '-o', options, self.path, mount_point], timeout)
+            if returncode is None:
+                err("Probing %s timed out" % self.path)
+                return False
+            if returncode != 0:
+                return True
+            mounted = True
+            if not info or "free" not in info:
+                stat = os.statvfs(mount_point)
+                self.set_usage(stat.f_blocks * stat.f_frsize,
+                               stat.f_bavail * stat.f_frsize,
+                               (stat.f_blocks - stat.f_bfree) * stat.f_frsize)
+            self.description = self.detect_os(mount_point)
             self.os_fs_info = ': {0.description} ({0.type}; {0.size}; {0.free_space})'.format(
-                self) if description else ': ' + self.type
+                self) if self.description else ': ' + self.type
             log("                  . self.description %s self.os_fs_info %s" % (
                 self.description, self.os_fs_info))
+            return True
         finally:
-            os.system('umount ' + TMP_MOUNTPOINT + ' 2>/dev/null')
+            if mounted or returncode is None:
+                run_timeout(['umount', '-l', mount_point], timeout)
+            try:
+                os.rmdir(mount_point)
+            except OSError:
+                pass
+
+    def detect_os(self, mount_point):
+        description = ''
+        if path_exists(mount_point, 'etc/linuxmint/info'):
+            description = read_shell_var(os.path.join(
+                mount_point, 'etc/linuxmint/info'), 'GRUB_TITLE')
+        elif path_exists(mount_point, 'Windows/servicing/Version'):
+            versions = os.listdir(os.path.join(
+                mount_point, 'Windows/servicing/Version'))
+            description = 'Windows ' + {
+                '6.4': '10',
+                '6.3': '8.1',
+                '6.2': '8',
+                '6.1': '7',
+                '6.0': 'Vista',
+                '5.2': 'XP Pro x64',
+                '5.1': 'XP',
+                '5.0': '2000',
+                '4.9': 'ME',
+                '4.1': '98',
+                '4.0': '95',
+            }.get(versions[0][:3] if versions else '', '')
+        elif path_exists(mount_point, 'Boot/BCD'):
+            description = 'Windows bootloader/recovery'
+        elif path_exists(mount_point, 'Windows/System32'):
+            description = 'Windows'
+        elif path_exists(mount_point, 'System/Library/CoreServices/SystemVersion.plist'):
+            description = 'Mac OS X'
+        elif path_exists(mount_point, 'etc/'):
+            description = read_shell_var(os.path.join(mount_point, 'etc/lsb-release'), 'DISTRIB_DESCRIPTION') or \
+                read_shell_var(os.path.join(mount_point, 'etc/os-release'), 'PRETTY_NAME') or \
+                'Unix'
+        elif "boot" in self.flags or "esp" in self.flags:
+            description = 'EFI System Partition'
+            self.efi = True
+            self.mount_as = EFI_MOUNT_POINT
+        return description
 
     def print_partition(self):
         log("Device: %s, format as: %s, mount as: %s" %
@@ -513,13 +751,7 @@ class PartitionDialog(object):
         self.builder.get_object("button_cancel").set_label(_("Cancel"))
         self.builder.get_object("button_ok").set_label(_("OK"))
         # Build supported filesystems list
-        filesystems = ['', 'swap', 'none']
-        for path in ["/bin", "/sbin", "/usr/bin", "/usr/sbin"]:
-            for fs in getoutput('echo %s/mkfs.*' % path).split():
-                fsname = str(fs).split("mkfs.")[1].replace("'", "")
-                if fsname not in filesystems and "*" not in fsname:
-                    filesystems.append(fsname)
-        filesystems = sorted(set(filesystems))
+        filesystems = sorted(set(['', 'swap', 'none'] + capabilities.host.filesystems))
         filesystems = sorted(filesystems, key=lambda x: 0 if x in (
             '', 'ext4') else 1 if x == 'swap' else 2)
         model = Gtk.ListStore(str)
@@ -1,5 +1,7 @@
 from frontend.gtk_interface import InstallerWindow
 from frontend import *
+from frontend.dialogs import MessageDialog, ErrorDialog
+import mediacheck
 
 gettext.install("live-installer", "/usr/share/locale")
 
@@ -20,17 +22,22 @@ class welcome:
     def connect_signal(self):
         self.trybut.connect("clicked", self.but_try)
         self.instbut.connect("clicked", self.but_install)
+        self.checkbut.connect("clicked", self.but_check)
 
     def define_objects(self):
         self.window = self.builder.get_object("window")
         self.wel = self.builder.get_object("welcome")
         self.trybut = self.builder.get_object("try")
         self.instbut = self.builder.get_object("install")
+        self.checkbut = self.builder.get_object("check")
+        self.checkstatus = self.builder.get_object("checkstatus")
 
     def i18n(self):
         self.wel.set_text(_("Welcome"))
         self.builder.get_object("trylabel").set_text(_("Try"))
         self.builder.get_object("installabel").set_text(_("Install"))
+        self.builder.get_object("checklabel").set_text(
+            _("Check the installation media"))
         self.builder.get_object("distro").set_text(
             config.get("distro_title", "17g"))
         self.builder.get_object("copyright").set_text(
@@ -42,3 +49,30 @@ class welcome:
     def but_install(self, widget):
         self.window.hide()
         InstallerWindow()
+
+    def but_check(self, widget):
+        self.checkbut.set_sensitive(False)
+        self.check_media()
+
+    @asynchronous
+    def check_media(self):
+        check = mediacheck.MediaCheck(mediacheck.find_image(),
+                                      progress=self.check_progress)
+        self.check_done(check.run())
+
+    @idle
+    def check_progress(self, done, total, rate, left):
+        self.checkstatus.set_text(_("%(percent)d%% checked, %(rate)d MB/s, %(left)d seconds left") % {
+            'percent': done * 100 // total if total else 100, 'rate': rate, 'left': left})
+
+    @idle
+    def check_done(self, stats):
+        self.checkbut.set_sensitive(True)
+        self.checkstatus.set_text(" ")
+        title = _("Check the installation media")
+        if stats["ok"] is False:
+            ErrorDialog(title, _("The installation media is damaged, please write it again or use another one."))
+        elif stats["ok"]:
+            MessageDialog(title, _("No errors found on the installation media."))
+        else:
+            MessageDialog(title, _("The installation media could be read, but it has no checksums to compare with."))
@@ -1,15 +1,44 @@
 import os
+import signal
 import subprocess
+from glob import glob
 import time
+import threading
 import gettext
 import parted
 import frontend.partitioning as partitioning
 import config
-from utils import run
+import locales
+import accounts
+import confedit
+import blocklist
+import capabilities
+import devices
+import diskpolicy
+import memguard
+import copier
+import verify
+import mediacheck
+from utils import run, asynchronous
 from logger import log, err, inf
 
 gettext.install("live-installer", "/usr/share/locale")
 
+# filesystems (and swap) which understand the discard mount option
+DISCARD_FILESYSTEMS = ("ext4", "xfs", "btrfs", "f2fs", "vfat", "swap")
+
+# kept as they are when an existing installation is repaired
+REPAIR_KEEP = ["etc/passwd", "etc/shadow", "etc/group", "etc/gshadow", "etc/subuid",
+               "etc/subgid", "etc/fstab", "etc/crypttab", "etc/hostname", "etc/hosts",
+               "etc/machine-id", "etc/locale.conf", "etc/vconsole.conf", "etc/localtime",
+               "etc/NetworkManager/system-connections", "etc/systemd/zram-generator.conf",
+               "etc/default/grub", "etc/default/grub.d", "etc/mkinitcpio.conf",
+               "etc/sysfs.d", "root", "var/log"]
+
+# mount points of the layers of an image install while installing
+IMAGE_LOWER = "/run/17g-image/lower"
+IMAGE_UPPER = "/run/17g-image/upper"
+
 NON_LATIN_KB_LAYOUTS = ['am', 'af', 'ara', 'ben', 'bd', 'bg', 'bn', 'bt', 'by', 'deva', 'et', 'ge', 'gh', 'gn', 'gr', 'guj', 'guru', 'id', 'il', 'iku', 'in', 'iq', 'ir', 'kan',
                         'kg', 'kh', 'kz', 'la', 'lao', 'lk', 'ma', 'mk', 'mm', 'mn', 'mv', 'mal', 'my', 'np', 'ori', 'pk', 'ru', 'rs', 'scc', 'sy', 'syr', 'tel', 'th', 'tj', 'tam', 'tz', 'ua', 'uz']
 
@@ -27,8 +56,23 @@ class InstallerEngine:
             err("Critical Error: Live medium (%s) not found!" % self.media)
             # sys.exit(1)
         inf("Using live medium: "+self.media)
+        self.source = "/source/"
+        self.target = "/target/"
+        self.prework = None
+        self.progresshook = None
+        self.copy_thread = None
+        self.copied_entries = None
+        self.copy_digests = None
+        self.repair = False
+        self.image_mode = False
+        self.auto_image_partition = None
+        self.copy_error = None
+        self.copy_failed = False
         self.our_total = 0
         self.our_current = 0
+        self.zram_writeback_device = None
+        self.memguard = None
+        self.stats = {}
 
     def set_progress_hook(self, progresshook):
         ''' Set a callback to be called on progress updates '''
@@ -46,7 +90,34 @@ class InstallerEngine:
             self.progresshook(self.our_current, self.our_total, pulse, done, message)
 
     def start_installation(self):
+        if self.copy_thread is None:
+            self.prepare_target()
+            self.copy_files()
+        else:
+            # pipelined: the copy started when the target was confirmed
+            log(" --> Waiting for the file copy")
+            self.copy_thread.join()
+            if self.copy_error is not None:
+                raise self.copy_error
+        if self.copy_failed:
+            err("Not configuring an incomplete copy")
+            return
+        self.configure_system()
+
+    def start_copy(self):
+        """ format, mount and copy in the background, the wizard is not finished yet """
+        self.copy_thread = self.run_copy()
+
+    @asynchronous
+    def run_copy(self):
+        try:
+            self.prepare_target()
+            self.copy_files()
+        except Exception as e:
+            err("Copy failed: %s" % e)
+            self.copy_error = e
 
+    def prepare_target(self):
         # mount the media location.
         log(" --> Installation started")
         if(not os.path.exists("/target")):
@@ -61,48 +132,66 @@ class InstallerEngine:
         run("umount -lf /target/proc/")
         run("umount -lf /target/run/")
 
-        self.mount_source()
+        if self.prework:
+            # it may be mounting /source right now, a finished scan is kept for the copy
+            self.prework.cancel()
+            self.prework.wait()
+        if not os.path.ismount("/source"):
+            self.mount_source()
 
+        # the wizard's probes mount partitions, none may hold a disk being formatted
         if self.setup.automated:
+            partitioning.wait_for_disk(self.setup.disk)
             self.create_partitions()
         else:
+            for disk_path in set(p.partition.disk.device.path for p in self.setup.partitions if p.format_as):
+                partitioning.wait_for_disk(disk_path)
             self.format_partitions()
             self.mount_partitions()
+            self.repair = self.repair_requested()
 
         # Custom commands
         self.do_pre_install_commands()
 
-        # Transfer the files
-        SOURCE = "/source/"
-        DEST = "/target/"
-        EXCLUDE_DIRS = "home/* dev/* proc/* sys/* tmp/* run/* mnt/* media/* lost+found source target".split()
+    def repair_requested(self):
+        """ update an existing installation in place instead of a fresh copy """
+        if not config.get("repair_install", False):
+            return False
+        root = [p for p in self.setup.partitions if p.mount_as == "/"]
+        if not root or root[0].format_as:
+            return False
+        if not os.path.exists("/target/etc/os-release"):
+            err("No installed system found on %s, doing a full install" % root[0].path)
+            return False
+        inf("Repairing the installed system on %s" % root[0].path)
+        return True
 
-        # Add optional entries to EXCLUDE_DIRS
-        for dirvar in config.get("exclude_dirs", ["/home"]):
-            EXCLUDE_DIRS.append(dirvar)
+    def copy_files(self):
+        if self.image_mode:
+            log(" --> Image install, the system was written as a whole")
+            return
+        # Transfer the files
+        SOURCE = self.source
+        DEST = self.target
+        EXCLUDE_DIRS = self.copy_excludes()
 
         self.our_current = 0
         # (Valid) assumption: num-of-files-to-copy ~= num-of-used-inodes-on-/
         self.our_total = int(subprocess.getoutput(
             "df --inodes /{src} | awk 'END{{ print $3 }}'".format(src=SOURCE.strip('/'))))
         log(" --> Copying {} files".format(self.our_total))
-        rsync_filter = ' '.join(
-            '--exclude=' + SOURCE + d for d in EXCLUDE_DIRS)
-        rsync = subprocess.Popen("rsync --verbose --archive --no-D --acls "
-                                 "--hard-links --xattrs {rsync_filter} "
-                                 "{src}* {dst}".format(src=SOURCE,
-                                                       dst=DEST, rsync_filter=rsync_filter),
-                                 shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        while rsync.poll() is None:
-            line = str(rsync.stdout.readline().decode(
-                "utf-8").replace("\n", ""))
-            if not line:  # still copying the previous file, just wait
-                time.sleep(0.1)
-            else:
-                self.our_current = min(self.our_current + 1, self.our_total)
-                self.update_progress(_("Copying /%s") % line)
-        log(_("rsync exited with return code: %s") % str(rsync.poll()))
+        guard = self.memguard = memguard.MemoryGuard()
+        guard.enable_swap(self.swap_devices())
+        if config.get("copy_engine", "rsync") == "native":
+            self.copy_native(SOURCE, DEST, EXCLUDE_DIRS, guard)
+        else:
+            self.copy_rsync(SOURCE, DEST, EXCLUDE_DIRS, guard)
+        self.stats["memory"] = guard.stats
+        # the native engine hashes while copying, what rsync copied is read again
+        if config.get("verify_copy", True):
+            self.verify_copy(SOURCE, DEST, EXCLUDE_DIRS)
 
+    def configure_system(self):
         # Steps:
         self.our_total = 12
         self.our_current = 0
@@ -120,11 +209,17 @@ class InstallerEngine:
         run("mv /target/etc/resolv.conf /target/etc/resolv.conf.bk")
         run("cp -f /etc/resolv.conf /target/etc/resolv.conf")
 
-        kernelversion = subprocess.getoutput("uname -r")
+        kernelversion = capabilities.host.kernel_version
         if os.path.exists("/lib/modules/{0}/vmlinuz".format(kernelversion)):
             run(
                 "cp /lib/modules/{0}/vmlinuz /target/boot/vmlinuz-{0}".format(kernelversion))
 
+        if self.repair:
+            # users, login settings and the mounts of the installed system stay
+            log(" --> Repair: keeping users, login settings and /etc/fstab")
+            self.our_current += 3
+            return
+
         # add new user
         log(" --> Adding new user")
         self.our_current += 1
@@ -136,49 +231,61 @@ class InstallerEngine:
         self.update_progress(_("Adding new user to the system"))
         # TODO: support encryption
 
-        run('chroot||useradd -m -s {shell} -c \"{realname}\" {username}'.format(
-            shell=config.get("using_shell", "/bin/bash"), realname=self.setup.real_name,
-            username=self.setup.username))
-
-        # Add user to additional groups
-        for group in config.get("additional_user_groups", ["audio", "video", "netdev"]):
-            run("chroot||usermod -aG {} {}".format(group, self.setup.username))
-
-        if (run("which chpasswd &>/dev/null") == 0) and config.get("use_chpasswd", True):
-            fp = open("/target/tmp/.passwd", "w")
-            fp.write(self.setup.username + ":" + self.setup.password1 + "\n")
-            if config.get("set_root_password", True):
-                fp.write("root:" + self.setup.password1 + "\n")
-            fp.close()
-            run("chroot||cat /tmp/.passwd | chpasswd")
-            run("chroot||rm -f /tmp/.passwd")
-        else:
-            run("chroot||echo -e \"{0}\\n{0}\\n\" | passwd {1}".format(
-                self.setup.password1, self.setup.username))
-            if config.get("set_root_password", True):
-                run("chroot||echo -e \"{0}\\n{0}\\n\" | passwd".format(
-                    self.setup.password1))
+        self.do_create_user()
 
         self.our_current += 1
         self.update_progress(_("Applying login settings"))
-        # Set LightDM to show user list by default
-        if config.get("list_users_when_auto_login", True):
-            run(r"chroot||sed -i -r 's/^#?(greeter-hide-users)\s*=.*/\1=false/' /etc/lightdm/lightdm.conf")
-        else:
-            run(r"chroot||sed -i -r 's/^#?(greeter-hide-users)\s*=.*/\1=true/' /etc/lightdm/lightdm.conf")
-
-        # Set autologin for user if they so elected
-        if self.setup.autologin:
-            # LightDM and Auto Login Groups
-            run("""chroot||groupadd -r autologin && gpasswd -a {user} autologin
-                                  && groupadd -r nopasswdlogin & & gpasswd -a {user} nopasswdlogin""".format(user=self.setup.username))
-            run(r"chroot||sed -i -r 's/^#?(autologin-user)\s*=.*/\1={user}/' /etc/lightdm/lightdm.conf".format(
-                user=self.setup.username))
+        if os.path.isfile("/target/etc/lightdm/lightdm.conf"):
+            with confedit.IniFile("/target/etc/lightdm/lightdm.conf") as f:
+                # Set LightDM to show user list by default
+                if config.get("list_users_when_auto_login", True):
+                    f.set("greeter-hide-users", "false", "Seat:*")
+                else:
+                    f.set("greeter-hide-users", "true", "Seat:*")
+                # Set autologin for user if they so elected
+                # (autologin groups are created with the user account)
+                if self.setup.autologin:
+                    f.set("autologin-user", self.setup.username, "Seat:*")
 
         # /etc/fstab, mtab and crypttab
         self.our_current += 1
         self.update_progress(_("Writing filesystem mount information to /etc/fstab"))
         self.write_fstab()
+        if config.get("swap_mode", "partition") == "zram":
+            self.write_zram_config()
+
+    def do_create_user(self):
+        groups = list(config.get("additional_user_groups", ["audio", "video", "netdev"]))
+        system_groups = []
+        if self.setup.autologin:
+            # LightDM and Auto Login Groups
+            system_groups = ["autologin", "nopasswdlogin"]
+        users = [self.setup.username]
+        if config.get("set_root_password", True):
+            users.append("root")
+        with accounts.AccountDatabase("/target") as db:
+            db.add_user(self.setup.username, self.setup.real_name,
+                        config.get("using_shell", "/bin/bash"))
+            for group in system_groups:
+                db.add_group(group, system=True)
+            db.add_members(self.setup.username, groups + system_groups)
+            if not config.get("use_chpasswd", True):
+                # hashed here, users whose password can't be hashed use chpasswd
+                users = [name for name in users
+                         if not db.set_password(name, self.setup.password1)]
+            db.create_home(self.setup.username)
+        if users:
+            self.do_chpasswd(users)
+
+    def do_chpasswd(self, users):
+        # the target's chpasswd hashes with its own PAM / login.defs setup
+        passwords = "".join(name + ":" + self.setup.password1 + "\n" for name in users)
+        # passwords go through a pipe, never to a file
+        chpasswd = subprocess.run(["chroot", "/target", "chpasswd"],
+                                  input=passwords.encode("utf-8"))
+        if chpasswd.returncode != 0:
+            err("Failed to set passwords (chpasswd exited with {})".format(
+                chpasswd.returncode))
 
     def mount_source(self):
         # Mount the installation media
@@ -188,56 +295,186 @@ class InstallerEngine:
         log(" ------ Mounting %s on %s" % (self.media, "/source/"))
         self.do_mount(self.media, "/source/")
 
+    def copy_excludes(self):
+        excludes = "home/* dev/* proc/* sys/* tmp/* run/* mnt/* media/* lost+found source target".split()
+        # Add optional entries to EXCLUDE_DIRS
+        for dirvar in config.get("exclude_dirs", ["/home"]):
+            excludes.append(dirvar)
+        return excludes
+
+    def copy_rsync(self, source, dest, exclude, guard):
+        # in repair mode rsync's quick check skips unchanged files, other
+        # filesystems mounted in the target (/boot, the ESP) are kept too
+        command = copier.rsync_command(source, dest, exclude, delta=self.repair,
+                                       keep=config.get("repair_keep", REPAIR_KEEP) + self.target_mounts())
+        log("Running: " + " ".join(command))
+        rsync = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+        # pause all rsync processes while memory is short
+        guard.subscribe(lambda throttled: os.killpg(
+            rsync.pid, signal.SIGSTOP if throttled else signal.SIGCONT))
+        guard.start()
+        transferred = []
+        while rsync.poll() is None:
+            line = str(rsync.stdout.readline().decode(
+                "utf-8").replace("\n", ""))
+            if not line:  # still copying the previous file, just wait
+                time.sleep(0.1)
+            else:
+                self.our_current = min(self.our_current + 1, self.our_total)
+                self.update_progress(_("Copying /%s") % line)
+                transferred.append(line)
+        guard.stop()
+        # what rsync copied, its summary lines are not files of the source
+        self.copied_entries = []
+        for relpath in transferred:
+            try:
+                self.copied_entries.append((relpath, os.lstat(os.path.join(source, relpath))))
+            except OSError:
+                pass
+        log(_("rsync exited with return code: %s") % str(rsync.poll()))
+        # 24: files vanished from the source while copying, not from the image
+        if rsync.poll() not in (0, 24):
+            self.copy_failed_with(_("Copying the system failed (rsync exited with %d).") % rsync.poll())
+
+    def target_mounts(self):
+        """ mount points below /target, relative to it """
+        mounts = []
+        with open("/proc/self/mountinfo", "r") as f:
+            for line in f:
+                mountpoint = line.split()[4]
+                if mountpoint.startswith(self.target):
+                    mounts.append(mountpoint[len(self.target):])
+        return mounts
+
+    def copy_failed_with(self, message):
+        """ report through the error hook, the installation stops after the copy """
+        self.copy_failed = True
+        self.error_message(message=message)
+
+    def copy_native(self, source, dest, exclude, guard):
+        lock = threading.Lock()
+
+        def progress(relpath):
+            with lock:
+                self.our_current = min(self.our_current + 1, self.our_total)
+            self.update_progress(_("Copying /%s") % relpath)
+        engine = copier.Copier(source, dest, exclude,
+                               workers=config.get("copy_workers", 4),
+                               streaming=config.get("copy_streaming", True),
+                               progress=progress,
+                               order=config.get("copy_order", "layout"),
+                               layout=copier.load_layout(config.get("copy_layout_file", None)),
+                               delta=self.repair,
+                               compare=config.get("repair_compare", "mtime"),
+                               keep=config.get("repair_keep", REPAIR_KEEP),
+                               digest=config.get("verify_copy", True))
+        # fewer parallel reads and writes while memory is short
+        guard.subscribe(engine.throttle)
+        # the tree was probably scanned while the user answered the wizard
+        entries = None
+        if self.prework:
+            entries = self.prework.take_manifest()
+            self.stats["prework"] = self.prework.stats
+        guard.start()
+        try:
+            self.stats["copy"] = engine.run(entries)
+        finally:
+            guard.stop()
+        if self.stats["copy"]["errors"]:
+            self.copy_failed_with(_("%d files could not be copied, see the log for details.") %
+                                  self.stats["copy"]["errors"])
+        self.copied_entries = engine.entries
+        self.copy_digests = engine.digests
+
+    def verify_copy(self, source, dest, exclude):
+        """ read the copied files back and copy the broken ones again """
+        engine = copier.Copier(source, dest, exclude)
+        entries = self.copied_entries or []
+        if self.repair:
+            # the kept files differ from the image on purpose
+            engine.keep = [k.strip("/") for k in config.get("repair_keep", REPAIR_KEEP)]
+            entries = [e for e in entries if not engine.protected(e[0])]
+        lock = threading.Lock()
+        start = time.monotonic()
+
+        def progress(relpath, done):
+            with lock:
+                self.our_current = min(self.our_current + 1, self.our_total)
+            elapsed = time.monotonic() - start
+            rate = done / 1000000 / elapsed if elapsed else 0
+            self.update_progress(_("Verifying /%(file)s (%(rate)d MB/s)") % {
+                'file': relpath, 'rate': rate})
+        verifier = verify.Verifier(source, dest, entries,
+                                   workers=config.get("verify_workers", 4),
+                                   recopy=engine.copy_file, progress=progress,
+                                   digests=self.copy_digests)
+        self.our_current = 0
+        self.our_total = len(verifier.files)
+        log(" --> Verifying {} files".format(self.our_total))
+        self.stats["verify"] = verifier.run()
+        if self.stats["verify"]["failed"]:
+            self.copy_failed_with(_(
+                "%d files could not be copied correctly, the installation media or the target disk may be damaged.") % self.stats["verify"]["failed"])
+
+    def swap_devices(self):
+        """ swap partitions of the new system which are not active yet """
+        if self.setup.automated:
+            return []  # the LVM swap volume is enabled when it is created
+        return [p.path for p in self.setup.partitions
+                if p.format_as == "swap" or (p.mount_as == "swap" and p.type == "swap")]
+
     def create_partitions(self):
         # Create partitions on the selected disk (automated installation)
-        partition_prefix = ""
-        if self.setup.disk.startswith("/dev/nvme"):
-            partition_prefix = "p"
-        if self.setup.luks:
+        self.image_mode = self.image_requested()
+        if self.image_mode:
+            self.create_image_partitions()
+            return
+        if self.setup.luks or diskpolicy.needs_boot_partition(self.setup.disk):
             if self.setup.gptonefi:
-                # EFI+LUKS/LVM
+                # EFI+LUKS/LVM or a root filesystem grub can't boot from
                 # sdx1=EFI, sdx2=BOOT, sdx3=ROOT
-                self.auto_efi_partition = self.setup.disk + partition_prefix + "1"
-                self.auto_boot_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_efi_partition = devices.partition_path(self.setup.disk, 1)
+                self.auto_boot_partition = devices.partition_path(self.setup.disk, 2)
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "3"
+                self.auto_root_partition = devices.partition_path(self.setup.disk, 3)
             else:
-                # BIOS+LUKS/LVM
+                # BIOS+LUKS/LVM or a root filesystem grub can't boot from
                 # sdx1=BOOT, sdx2=ROOT
                 self.auto_efi_partition = None
-                self.auto_boot_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_boot_partition = devices.partition_path(self.setup.disk, 1)
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_root_partition = devices.partition_path(self.setup.disk, 2)
         elif self.setup.lvm:
             if self.setup.gptonefi:
                 # EFI+LVM
                 # sdx1=EFI, sdx2=ROOT
-                self.auto_efi_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_efi_partition = devices.partition_path(self.setup.disk, 1)
                 self.auto_boot_partition = None
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_root_partition = devices.partition_path(self.setup.disk, 2)
             else:
                 # BIOS+LVM:
                 # sdx1=ROOT
                 self.auto_efi_partition = None
                 self.auto_boot_partition = None
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_root_partition = devices.partition_path(self.setup.disk, 1)
         else:
             if self.setup.gptonefi:
                 # EFI
                 # sdx1=EFI, sdx2=ROOT
-                self.auto_efi_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_efi_partition = devices.partition_path(self.setup.disk, 1)
                 self.auto_boot_partition = None
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_root_partition = devices.partition_path(self.setup.disk, 2)
             else:
                 # BIOS:
                 # sdx1=ROOT
                 self.auto_efi_partition = None
                 self.auto_boot_partition = None
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_root_partition = devices.partition_path(self.setup.disk, 1)
 
         log("EFI:"+str(self.auto_efi_partition))
         log("BOOT:"+str(self.auto_boot_partition))
@@ -256,6 +493,7 @@ class InstallerEngine:
         self.update_progress(_("Creating partitions on %s") % self.setup.disk)
         log(" --> Creating partitions on %s" % self.setup.disk)
         disk_device = parted.getDevice(self.setup.disk)
+        profile = diskpolicy.select_profile(self.setup.disk)
         # replae this with changeable function
         partitioning.full_disk_format(disk_device, create_boot=(
             self.auto_boot_partition is not None), create_swap=(self.auto_swap_partition is not None))
@@ -279,22 +517,29 @@ class InstallerEngine:
             run("vgcreate -y lvmlmde %s" % self.auto_root_partition)
             log(" --> LVM: Creating LV root")
             run("lvcreate -y -n root -L 1GB lvmlmde")
-            log(" --> LVM: Creating LV swap")
-            swap_size = int(round(int(subprocess.getoutput(
-                "awk '/^MemTotal/{ print $2 }' /proc/meminfo")) / 1024, 0))
-            run("lvcreate -y -n swap -L %dMB lvmlmde" % swap_size)
+            if config.get("swap_mode", "partition") == "zram":
+                writeback_size = int(config.get("zram_writeback_size", 0))
+                if writeback_size:
+                    log(" --> LVM: Creating LV zram writeback")
+                    run("lvcreate -y -n zwriteback -L %dMB lvmlmde" % writeback_size)
+                    self.zram_writeback_device = "/dev/mapper/lvmlmde-zwriteback"
+            else:
+                log(" --> LVM: Creating LV swap")
+                swap_size = int(round(capabilities.host.mem_total_kb / 1024, 0))
+                run("lvcreate -y -n swap -L %dMB lvmlmde" % swap_size)
             log(" --> LVM: Extending LV root")
             run("lvextend -l 100\%FREE /dev/lvmlmde/root")
             log(" --> LVM: Formatting LV root")
-            run("mkfs.ext4 /dev/mapper/lvmlmde-root -FF")
-            log(" --> LVM: Formatting LV swap")
-            run("mkswap -f /dev/mapper/lvmlmde-swap")
-            log(" --> LVM: Enabling LV swap")
-            run("swapon /dev/mapper/lvmlmde-swap")
+            run(diskpolicy.mkfs_command(profile, "/dev/mapper/lvmlmde-root"))
             self.auto_root_partition = "/dev/mapper/lvmlmde-root"
-            self.auto_swap_partition = "/dev/mapper/lvmlmde-swap"
-
-        self.do_mount(self.auto_root_partition, "/target", "ext4", None)
+            if config.get("swap_mode", "partition") != "zram":
+                log(" --> LVM: Formatting LV swap")
+                run("mkswap -f /dev/mapper/lvmlmde-swap")
+                log(" --> LVM: Enabling LV swap")
+                run("swapon /dev/mapper/lvmlmde-swap")
+                self.auto_swap_partition = "/dev/mapper/lvmlmde-swap"
+
+        self.do_mount(self.auto_root_partition, "/target", profile["filesystem"], None)
         if (self.auto_boot_partition is not None):
             run("mkdir -p /target/boot")
             self.do_mount(self.auto_boot_partition,
@@ -309,6 +554,139 @@ class InstallerEngine:
                 self.do_mount(self.auto_efi_partition,
                               "/target/boot/efi", "vfat", None)
 
+    def image_requested(self):
+        """ deploy the live image as it is under a writable overlay instead of copying it """
+        if config.get("install_mode", "copy") != "image":
+            return False
+        if self.setup.luks or self.setup.lvm:
+            err("Image installs support neither LVM nor encryption, copying the files instead")
+            return False
+        return True
+
+    def create_image_partitions(self):
+        """ EFI, /boot, the read-only image and the writable upper layer """
+        image = mediacheck.find_image(self.media)
+        with open(image, "rb") as f:
+            image_bytes = f.seek(0, os.SEEK_END)
+        # room for larger images when the read-only layer is replaced later
+        image_mb = int(config.get("image_partition_mb", 0)) or \
+            -(-image_bytes * 3 // 2 // (1024 * 1024))
+        partitions = ["efi"] if self.setup.gptonefi else []
+        partitions += ["boot", "image", "root"]
+        path = dict((name, devices.partition_path(self.setup.disk, number + 1))
+                    for number, name in enumerate(partitions))
+        self.auto_efi_partition = path.get("efi")
+        self.auto_boot_partition = path["boot"]
+        self.auto_swap_partition = None
+        self.auto_image_partition = path["image"]
+        self.auto_root_partition = self.auto_root_physical_partition = path["root"]
+        log(" --> Image install: {}".format(path))
+
+        self.update_progress(_("Creating partitions on %s") % self.setup.disk)
+        profile = diskpolicy.select_profile(self.setup.disk)
+        partitioning.full_disk_format(parted.getDevice(self.setup.disk), create_boot=True,
+                                      image_size=image_mb)
+        self.write_image(image, image_bytes, self.auto_image_partition)
+
+        # the same layers as the initramfs assembles them on boot
+        os.makedirs(IMAGE_LOWER, exist_ok=True)
+        os.makedirs(IMAGE_UPPER, exist_ok=True)
+        self.do_mount(self.auto_image_partition, IMAGE_LOWER, "squashfs", "ro")
+        self.do_mount(self.auto_root_partition, IMAGE_UPPER, profile["filesystem"], None)
+        os.makedirs(IMAGE_UPPER + "/upper", exist_ok=True)
+        os.makedirs(IMAGE_UPPER + "/work", exist_ok=True)
+        self.do_mount("overlay", "/target", "overlay", "lowerdir={},upperdir={}/upper,workdir={}/work".format(
+            IMAGE_LOWER, IMAGE_UPPER, IMAGE_UPPER))
+        # grub reads the kernel from a real filesystem
+        run("mkdir -p /target/boot")
+        self.do_mount(self.auto_boot_partition, "/target/boot", "ext4", None)
+        run("cp -a /source/boot/. /target/boot/")
+        if self.auto_efi_partition is not None:
+            run("mkdir -p /target/boot/efi")
+            self.do_mount(self.auto_efi_partition, "/target/boot/efi", "vfat", None)
+
+    def write_image(self, image, size, device):
+        """ the read-only layer, one sequential write of the live image """
+        log(" --> Writing %s to %s" % (image, device))
+        self.our_current = 0
+        self.our_total = max(1, size // 1000000)
+        start = time.monotonic()
+        done = flushed = 0
+        with open(image, "rb", buffering=0) as src:
+            fd = os.open(device, os.O_WRONLY)
+            try:
+                while done < size:
+                    block = memoryview(src.read(copier.CHUNK))
+                    if not block:
+                        break
+                    written = 0
+                    while written < len(block):
+                        written += os.write(fd, block[written:])
+                    # the image is not read again
+                    os.posix_fadvise(src.fileno(), done, written, os.POSIX_FADV_DONTNEED)
+                    done += written
+                    if done - flushed >= 8 * copier.CHUNK:
+                        # written back first, clean pages can be dropped
+                        os.fdatasync(fd)
+                        os.posix_fadvise(fd, flushed, done - flushed, os.POSIX_FADV_DONTNEED)
+                        flushed = done
+                    elapsed = time.monotonic() - start
+                    self.our_current = done // 1000000
+                    self.update_progress(_("Writing the system image (%d MB/s)") % (
+                        done / 1000000 / elapsed if elapsed else 0))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        elapsed = time.monotonic() - start
+        self.stats["image"] = {"bytes": done, "seconds": round(elapsed, 1),
+                               "mb_per_second": round(done / 1000000 / elapsed, 1) if elapsed else 0}
+        log("Image written: {}".format(self.stats["image"]))
+        if done != size:
+            self.error_message(message=_("The system image could not be written to %s.") % device)
+
+    def blkid_value(self, path, tag):
+        return subprocess.getoutput("blkid -s %s -o value %s" % (tag, path)).strip()
+
+    def configure_overlay_initramfs(self):
+        """ the initramfs mounts the image and the upper layer as the root """
+        files = config.initramfs.get("overlay_files", {})
+        if not files:
+            self.error_message(message=_(
+                "The initramfs system %s can not boot image installs.") % config.initramfs["name"])
+            return
+        # autodetect sees the overlay root, the upper layer's module is added by name
+        upper_filesystem = diskpolicy.select_profile(self.setup.disk)["filesystem"]
+        for path, content in files.items():
+            os.makedirs(os.path.dirname("/target" + path), exist_ok=True)
+            confedit.atomic_write("/target" + path,
+                                  content.replace("{upper_filesystem}", upper_filesystem))
+        for command in config.initramfs.get("overlay_commands", []):
+            run("chroot||" + command)
+
+    def write_image_grub_config(self):
+        """ grub-mkconfig can not probe an overlay root, the entries are written here """
+        boot_uuid = self.blkid_value(self.auto_boot_partition, "UUID")
+        options = "overlay_lower=PARTUUID={} overlay_upper=PARTUUID={} overlay_upper_fstype={} rw".format(
+            self.blkid_value(self.auto_image_partition, "PARTUUID"),
+            self.blkid_value(self.auto_root_partition, "PARTUUID"),
+            diskpolicy.select_profile(self.setup.disk)["filesystem"])
+        microcode = " ".join("/" + os.path.basename(p) for p in sorted(glob("/target/boot/*-ucode.img")))
+        lines = ["set default=0", "set timeout=5", "insmod part_gpt", "insmod part_msdos",
+                 "insmod ext2", "search --no-floppy --fs-uuid --set=root %s" % boot_uuid, ""]
+        title = config.get("distro_title", "17g")
+        for kernel in sorted(glob("/target/boot/vmlinuz-*")):
+            name = os.path.basename(kernel)[len("vmlinuz-"):]
+            for initrd, suffix in (("initramfs-%s.img" % name, ""),
+                                   ("initramfs-%s-fallback.img" % name, " (fallback initramfs)")):
+                if not os.path.exists("/target/boot/" + initrd):
+                    continue
+                lines.append("menuentry '%s, %s%s' {" % (title, name, suffix))
+                lines.append("    linux /vmlinuz-%s %s quiet" % (name, options))
+                lines.append("    initrd %s" % " ".join(p for p in (microcode, "/" + initrd) if p))
+                lines.append("}")
+        os.makedirs("/target/boot/grub", exist_ok=True)
+        confedit.atomic_write("/target/boot/grub/grub.cfg", "\n".join(lines) + "\n")
+
     def format_partitions(self):
         for partition in self.setup.partitions:
             if(partition.format_as is not None and partition.format_as != ""):
@@ -386,6 +764,64 @@ class InstallerEngine:
                 break
         return uuid
 
+    def trim_mode(self, disk):
+        """ online, periodic or None for partitions of disk """
+        mode = config.get("discard_mode", "periodic")
+        if not disk or mode not in ("online", "periodic"):
+            return None
+        profile = diskpolicy.select_profile(disk)
+        if profile["rotational"] or not profile["discard"]:
+            return None
+        return mode
+
+    def fstab_options(self, fs, disk):
+        """ mount options by filesystem and the class of the disk it lives on """
+        flash = disk is not None and not diskpolicy.select_profile(disk)["rotational"]
+        if fs == "swap":
+            options = ["sw"]
+        else:
+            options = ["defaults"]
+            if fs in ("ext2", "ext3", "ext4", "xfs", "btrfs", "f2fs"):
+                # no metadata write on every read, timestamps still kept
+                options.append("noatime" if flash else "lazytime")
+            commit = config.get("flash_commit_interval", 60)
+            if fs in ("ext3", "ext4", "btrfs") and flash and commit:
+                options.append("commit=%d" % int(commit))
+        if self.trim_mode(disk) == "online" and fs in DISCARD_FILESYSTEMS:
+            options.append("discard")
+        return ",".join(options)
+
+    def fstab_entries(self):
+        """ (comment, device, mount point, fs, disk) of the installed system """
+        entries = []
+        if self.setup.automated:
+            disk = self.setup.disk
+            root_fs = diskpolicy.select_profile(disk)["filesystem"]
+            if self.image_mode:
+                pass  # the initramfs assembles /
+            elif self.setup.lvm:
+                # Don't use UUIDs with LVM
+                entries.append((None, self.auto_root_partition, "/", root_fs, disk))
+                entries.append((None, self.auto_swap_partition, "swap", "swap", disk))
+            else:
+                entries.append((self.auto_root_partition, self.auto_root_partition, "/", root_fs, disk))
+                entries.append((self.auto_swap_partition, self.auto_swap_partition, "swap", "swap", disk))
+            entries.append((self.auto_boot_partition, self.auto_boot_partition, "/boot", "ext4", disk))
+            entries.append((self.auto_efi_partition, self.auto_efi_partition, "/boot/efi", "vfat", disk))
+        else:
+            for partition in self.setup.partitions:
+                if partition.mount_as in (None, "", "None"):
+                    continue
+                if partition.type == "fat16" or partition.type == "fat32":
+                    fs = "vfat"
+                else:
+                    fs = partition.type
+                mount_as = "swap" if fs == "swap" else partition.mount_as
+                entries.append((partition.path, partition.path, mount_as, fs,
+                                partition.partition.disk.device.path))
+        # automated layouts without swap or /boot leave None devices
+        return [e for e in entries if e[1] is not None]
+
     def write_fstab(self):
         # write the /etc/fstab
         log(" --> Writing fstab")
@@ -393,228 +829,70 @@ class InstallerEngine:
         if(not os.path.exists("/target/etc/fstab")):
             run(
                 "echo \"#### Static Filesystem Table File\" > /target/etc/fstab")
-        fstab = open("/target/etc/fstab", "a")
-        fstab.write("proc\t/proc\tproc\tdefaults\t0\t0\n")
-        if self.setup.automated:
-            if self.setup.lvm:
-                # Don't use UUIDs with LVM
-                fstab.write("%s /  ext4 defaults 0 1\n" %
-                            self.auto_root_partition)
-                fstab.write("%s none   swap sw 0 0\n" %
-                            self.auto_swap_partition)
-            else:
-                fstab.write("# %s\n" % self.auto_root_partition)
-                fstab.write("%s /  ext4 defaults 0 1\n" %
-                            self.get_blkid(self.auto_root_partition))
-                fstab.write("# %s\n" % self.auto_swap_partition)
-                fstab.write("%s none   swap sw 0 0\n" %
-                            self.get_blkid(self.auto_swap_partition))
-            if (self.auto_boot_partition is not None):
-                fstab.write("# %s\n" % self.auto_boot_partition)
-                fstab.write("%s /boot  ext4 defaults 0 1\n" %
-                            self.get_blkid(self.auto_boot_partition))
-            if (self.auto_efi_partition is not None):
-                fstab.write("# %s\n" % self.auto_efi_partition)
-                fstab.write("%s /boot/efi  vfat defaults 0 1\n" %
-                            self.get_blkid(self.auto_efi_partition))
-        else:
-            for partition in self.setup.partitions:
-                if (partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "None"):
-                    fstab.write("# %s\n" % (partition.path))
-                    if(partition.mount_as == "/"):
-                        fstab_fsck_option = "1"
-                    else:
-                        fstab_fsck_option = "0"
-
-                    if("ext" in partition.type):
-                        fstab_mount_options = "defaults,rw"
-                    else:
-                        fstab_mount_options = "defaults"
-
-                    if partition.type == "fat16" or partition.type == "fat32":
-                        fs = "vfat"
-                    else:
-                        fs = partition.type
-
-                    partition_uuid = self.get_blkid(partition.path)
-                    if(fs == "swap"):
-                        fstab.write("%s\tswap\tswap\tsw\t0\t0\n" %
-                                    partition_uuid)
-                    else:
-                        fstab.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (
-                            partition_uuid, partition.mount_as, fs, fstab_mount_options, "0", fstab_fsck_option))
-            fstab.close()
+        periodic_trim = False
+        with open("/target/etc/fstab", "a") as fstab:
+            fstab.write("proc\t/proc\tproc\tdefaults\t0\t0\n")
+            if self.image_mode:
+                fstab.write("# / is an overlay of %s (read-only image) and %s, mounted by the initramfs\n" % (
+                    self.auto_image_partition, self.auto_root_partition))
+            for comment, device, mount_as, fs, disk in self.fstab_entries():
+                if comment:
+                    fstab.write("# %s\n" % comment)
+                    device = self.get_blkid(device)
+                if mount_as == "/":
+                    fsck = 1
+                elif fs.startswith("ext") or fs == "vfat":
+                    fsck = 2
+                else:
+                    fsck = 0
+                fstab.write("%s\t%s\t%s\t%s\t0\t%d\n" % (
+                    device, "none" if fs == "swap" else mount_as, fs,
+                    self.fstab_options(fs, disk), fsck))
+                periodic_trim |= self.trim_mode(disk) == "periodic"
 
         if self.setup.lvm:
             run("grep -v swap /target/etc/fstab > /target/etc/mtab")
 
         if self.setup.luks:
-            run("echo 'lvmlmde   %s   none   luks,tries=3' >> /target/etc/crypttab" %
-                self.auto_root_physical_partition)
+            options = "luks,tries=3"
+            if self.trim_mode(self.setup.disk):
+                options += ",discard"
+            run("echo 'lvmlmde   %s   none   %s' >> /target/etc/crypttab" %
+                (self.auto_root_physical_partition, options))
+        if periodic_trim and os.path.exists("/target/usr/lib/systemd/system/fstrim.timer"):
+            log(" --> Enabling fstrim.timer")
+            run("chroot||systemctl enable fstrim.timer")
         inf(open("/target/etc/fstab", "r").read())
 
+    def write_zram_config(self):
+        """ compressed swap in RAM through systemd's zram-generator """
+        log(" --> Configuring zram swap")
+        os.makedirs("/target/etc/systemd", exist_ok=True)
+        with confedit.IniFile("/target/etc/systemd/zram-generator.conf") as f:
+            f.set("zram-size", config.get("zram_size", "min(ram / 2, 8192)"), "zram0")
+            f.set("compression-algorithm", config.get("zram_compression", "zstd"), "zram0")
+            f.set("swap-priority", "100", "zram0")
+            writeback = self.zram_writeback_device or config.get("zram_writeback_device", None)
+            if writeback:
+                f.set("writeback-device", writeback, "zram0")
+        if not os.path.exists("/target/usr/lib/systemd/system-generators/zram-generator"):
+            err("zram-generator is not installed in the target, add it to extra_packages")
+
     def finish_installation(self):
         # Steps:
         self.our_total = 12
         self.our_current = 4
 
-        # write host+hostname infos
-        log(" --> Writing hostname")
-        self.our_current += 1
-        self.update_progress(_("Setting hostname"))
-        hostnamefh = open("/target/etc/hostname", "w")
-        hostnamefh.write("%s\n" % self.setup.hostname)
-        hostnamefh.close()
-        hostsfh = open("/target/etc/hosts", "w")
-        hostsfh.write("127.0.0.1\tlocalhost\n")
-        hostsfh.write("127.0.1.1\t%s\n" % self.setup.hostname)
-        hostsfh.write(
-            "# The following lines are desirable for IPv6 capable hosts\n")
-        hostsfh.write("::1     localhost ip6-localhost ip6-loopback\n")
-        hostsfh.write("fe00::0 ip6-localnet\n")
-        hostsfh.write("ff00::0 ip6-mcastprefix\n")
-        hostsfh.write("ff02::1 ip6-allnodes\n")
-        hostsfh.write("ff02::2 ip6-allrouters\n")
-        hostsfh.write("ff02::3 ip6-allhosts\n")
-        # Append hosts file from branding
-        if os.path.isfile("./branding/hosts"):
-            f = open("./branding/hosts","r").readlines()
-            for line in f:
-                hostsfh.write(line)
-        hostsfh.close()
-
-        # set the locale
-        log(" --> Setting the locale")
-        self.our_current += 1
-        self.update_progress(_("Setting locale"))
-        run("echo \"%s.UTF-8 UTF-8\" >> /target/etc/locale.gen" %
-            self.setup.language)
-        run("chroot||locale-gen")
-        run("echo \"\" > /target/etc/default/locale")
-        run("chroot||localectl set-locale LANG=\"%s.UTF-8\"" %
-            self.setup.language)
-        run("chroot||localectl set-locale LANG=%s.UTF-8" % self.setup.language)
-        open("/target/etc/locale.conf", "w").write("LANG=%s.UTF-8" %
-                                                   self.setup.language)
-        # set the locale for gentoo / sulin
-        if os.path.exists("/target/etc/env.d"):
-            l = open("/target/etc/env.d/20language", "w")
-            l.write("LANG={}.UTF-8".format(self.setup.language))
-            l.write("LC_ALL={}.UTF-8".format(self.setup.language))
-            l.flush()
-            l.close()
-            run("chroot||env-update")
-
-        # set the timezone
-        log(" --> Setting the timezone")
-        self.our_current += 1
-        self.update_progress(_("Setting timezone"))
-        run("echo \"%s\" > /target/etc/timezone" % self.setup.timezone)
-        run("rm -f /target/etc/localtime")
-        run("ln -s /usr/share/zoneinfo/%s /target/etc/localtime" %
-            self.setup.timezone)
-
-        # Keyboard settings X11
-        if not self.setup.keyboard_variant:
-            self.setup.keyboard_variant = ""
-        self.update_progress(("Settings X11 keyboard options"))
-        if os.path.exists("/target/etc/X11/xorg.conf.d"):
-            newconsolefh = open(
-                "/target/etc/X11/xorg.conf.d/10-keyboard.conf", "w")
+        locale_stage = None
+        if self.repair:
+            # the installed system keeps its own settings
+            log(" --> Repair: keeping hostname, locale, timezone and keyboard settings")
+            self.our_current += 4
         else:
-            newconsolefh = open(
-                "/target/usr/share/X11/xorg.conf.d/10-keyboard.conf", "w")
-        newconsolefh.write('Section "InputClass"\n')
-        newconsolefh.write('Identifier "system-keyboard"\n')
-        newconsolefh.write('MatchIsKeyboard "on"\n')
-        newconsolefh.write('Option "XkbLayout" "{}"\n'.format(
-            self.setup.keyboard_layout))
-        newconsolefh.write('Option "XkbModel" "{}"\n'.format(
-            self.setup.keyboard_model))
-        newconsolefh.write('Option "XkbVariant" "{}"\n'.format(
-            self.setup.keyboard_variant))
-        if "," in self.setup.keyboard_layout:
-            newconsolefh.write('Option "XkbOptions" "grp:ctrls_toggle"\n')
-        newconsolefh.write('EndSection\n')
-        newconsolefh.close()
-
-        # set the keyboard options..
-        log(" --> Setting the keyboard")
-        self.our_current += 1
-        self.update_progress(_("Setting keyboard options"))
-        if os.path.exists("/target/etc/default/console-setup"):
-            consolefh = open("/target/etc/default/console-setup", "r")
-            newconsolefh = open("/target/etc/default/console-setup.new", "w")
-            for line in consolefh:
-                line = line.rstrip("\r\n")
-                if(line.startswith("XKBMODEL=")):
-                    newconsolefh.write("XKBMODEL=\"%s\"\n" %
-                                       self.setup.keyboard_model)
-                elif(line.startswith("XKBLAYOUT=")):
-                    newconsolefh.write("XKBLAYOUT=\"%s\"\n" %
-                                       self.setup.keyboard_layout)
-                elif(line.startswith("XKBVARIANT=") and self.setup.keyboard_variant != ""):
-                    newconsolefh.write("XKBVARIANT=\"%s\"\n" %
-                                       self.setup.keyboard_variant)
-                else:
-                    newconsolefh.write("%s\n" % line)
-            consolefh.close()
-            newconsolefh.close()
-            run("chroot||rm /etc/default/console-setup")
-            run("chroot||mv /etc/default/console-setup.new /etc/default/console-setup")
+            locale_stage = self.configure_settings()
 
-        # lfs like systems uses vconsole.conf (systemd)
-        if os.path.exists("/target/etc/vconsole.conf"):
-            consolefh = open("/target/etc/vconsole.conf", "r")
-            newconsolefh = open("/target/etc/vconsole.conf.new", "w")
-            for line in consolefh:
-                line = line.rstrip("\r\n")
-                if(line.startswith("KEYMAP=")):
-                    if(self.setup.keyboard_variant != ""):
-                        newconsolefh.write(
-                            "KEYMAP=\"{0}-{1}\"\n".format(self.setup.keyboard_layout, self.setup.keyboard_variant))
-                    else:
-                        newconsolefh.write("KEYMAP=\"{0}\"\n".format(
-                            self.setup.keyboard_layout))
-                else:
-                    newconsolefh.write("%s\n" % line)
-            consolefh.close()
-            newconsolefh.close()
-            run("chroot||rm /etc/vconsole.conf")
-            run("chroot||mv /etc/vconsole.conf.new /etc/vconsole.conf")
-
-        # debian like systems uses this (systemd)
-        if os.path.exists("/target/etc/default/keyboard"):
-            consolefh = open("/target/etc/default/keyboard", "r")
-            newconsolefh = open("/target/etc/default/keyboard.new", "w")
-            for line in consolefh:
-                line = line.rstrip("\r\n")
-                if(line.startswith("XKBMODEL=")):
-                    newconsolefh.write("XKBMODEL=\"%s\"\n" %
-                                       self.setup.keyboard_model)
-                elif(line.startswith("XKBLAYOUT=")):
-                    newconsolefh.write("XKBLAYOUT=\"%s\"\n" %
-                                       self.setup.keyboard_layout)
-                elif(line.startswith("XKBVARIANT=") and self.setup.keyboard_variant != ""):
-                    newconsolefh.write("XKBVARIANT=\"%s\"\n" %
-                                       self.setup.keyboard_variant)
-                elif(line.startswith("XKBOPTIONS=")):
-                    newconsolefh.write("XKBOPTIONS=grp:ctrls_toggle")
-                else:
-                    newconsolefh.write("%s\n" % line)
-            consolefh.close()
-            newconsolefh.close()
-            run("chroot||rm /etc/default/keyboard")
-            run("chroot||mv /etc/default/keyboard.new /etc/default/keyboard")
-
-        # Keyboard settings openrc
-        if os.path.exists("/target/etc/conf.d/keymaps"):
-            newconsolefh = open("/target/etc/conf.d/keymaps", "w")
-            if not self.setup.keyboard_layout:
-                self.setup.keyboard_layout = "en"
-            newconsolefh.write("keymap=\"{}{}\"\n".format(
-                self.setup.keyboard_layout, self.setup.keyboard_variant))
-            newconsolefh.close()
+        # optional packages from the live medium
+        self.do_install_extra_packages()
 
         # remove pacman
         self.update_progress(_("Clearing package manager"),True)
@@ -623,12 +901,18 @@ class InstallerEngine:
         run("chroot||yes | {}".format(config.package_manager(
             "remove_package_with_unusing_deps", config.get("remove_packages", ["17g-installer"]))))
 
-        if self.setup.luks:
+        if self.setup.luks and not self.repair:
             with open("/target/etc/default/grub.d/61_live-installer.cfg", "w") as f:
                 f.write("#! /bin/sh\n")
                 f.write("set -e\n\n")
-                f.write('GRUB_CMDLINE_LINUX="cryptdevice=%s:lvmlmde root=/dev/mapper/lvmlmde-root resume=/dev/mapper/lvmlmde-swap"\n' %
-                        self.auto_root_physical_partition)
+                cryptdevice = "%s:lvmlmde" % self.auto_root_physical_partition
+                if self.trim_mode(self.setup.disk):
+                    cryptdevice += ":allow-discards"
+                resume = ""
+                if self.auto_swap_partition:
+                    resume = " resume=%s" % self.auto_swap_partition
+                f.write('GRUB_CMDLINE_LINUX="cryptdevice=%s root=/dev/mapper/lvmlmde-root%s"\n' %
+                        (cryptdevice, resume))
             run("chroot||echo \"power/disk = shutdown\" >> /etc/sysfs.d/local.conf")
 
         # recreate initramfs (needed in case of skip_mount also, to include things like mdadm/dm-crypt/etc in case its needed to boot a custom install)
@@ -636,6 +920,8 @@ class InstallerEngine:
         self.our_current += 1
         self.update_progress(_("Generating initramfs"))
 
+        if self.image_mode:
+            self.configure_overlay_initramfs()
         for command in config.update_initramfs():
             run("chroot||"+command)
         self.update_progress(_("Preparing bootloader installation"),True)
@@ -660,10 +946,13 @@ class InstallerEngine:
                 grub_cmd = config.distro["grub_installation_legacy"]
                 run(grub_cmd.replace("{disk}", self.setup.grub_device))
 
-            # fix not add windows grub entry
-            run("chroot||grub-mkconfig -o /boot/grub/grub.cfg")
             self.update_progress(_("Configuring bootloader"),True)
-            self.do_configure_grub()
+            if self.image_mode:
+                self.write_image_grub_config()
+            else:
+                # fix not add windows grub entry
+                run("chroot||grub-mkconfig -o /boot/grub/grub.cfg")
+                self.do_configure_grub()
             grub_retries = 0
             while (not self.do_check_grub()):
                 self.do_configure_grub()
@@ -673,6 +962,10 @@ class InstallerEngine:
                         "WARNING: The grub bootloader was not configured properly! You need to configure it manually."))
                     break
 
+        # wait for locale compilation
+        if locale_stage:
+            locale_stage.join()
+
         # Custom commands
         self.update_progress(_("Post install commands running"),True)
         self.do_post_install_commands()
@@ -696,12 +989,164 @@ class InstallerEngine:
         for partition in self.setup.partitions:
             if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
                 self.do_unmount("/target" + partition.mount_as)
+        if self.memguard:
+            self.memguard.disable_swap()
         self.do_unmount("/target")
+        if self.image_mode:
+            self.do_unmount(IMAGE_UPPER)
+            self.do_unmount(IMAGE_LOWER)
         self.do_unmount("/source")
 
+        inf("Install statistics: {}".format(self.stats))
         self.update_progress(_("Installation finished"),done=True)
         log(" --> All done")
 
+    def configure_settings(self):
+        """ hostname, locale, timezone and keyboard, returns the locale thread """
+        # write host+hostname infos
+        log(" --> Writing hostname")
+        self.our_current += 1
+        self.update_progress(_("Setting hostname"))
+        confedit.atomic_write("/target/etc/hostname", "%s\n" % self.setup.hostname)
+        hostsfh = open("/target/etc/hosts", "w")
+        hostsfh.write("127.0.0.1\tlocalhost\n")
+        hostsfh.write("127.0.1.1\t%s\n" % self.setup.hostname)
+        hostsfh.write(
+            "# The following lines are desirable for IPv6 capable hosts\n")
+        hostsfh.write("::1     localhost ip6-localhost ip6-loopback\n")
+        hostsfh.write("fe00::0 ip6-localnet\n")
+        hostsfh.write("ff00::0 ip6-mcastprefix\n")
+        hostsfh.write("ff02::1 ip6-allnodes\n")
+        hostsfh.write("ff02::2 ip6-allrouters\n")
+        hostsfh.write("ff02::3 ip6-allhosts\n")
+        # Ad-blocking list from branding, /etc/hosts or local resolver
+        blocklist.deploy(hostsfh)
+        hostsfh.close()
+
+        # set the locale
+        log(" --> Setting the locale")
+        self.our_current += 1
+        self.update_progress(_("Setting locale"))
+        # precompiled data is copied, otherwise only this locale is
+        # compiled while the other stages keep going
+        locale_stage = self.do_install_locale("%s.UTF-8" % self.setup.language)
+        locale_files = ["/target/etc/locale.conf"]
+        if os.path.exists("/target/etc/default"):
+            locale_files.append("/target/etc/default/locale")
+        for path in locale_files:
+            with confedit.KeyValueFile(path) as f:
+                f.set("LANG", "%s.UTF-8" % self.setup.language, quote=False)
+        # set the locale for gentoo / sulin
+        if os.path.exists("/target/etc/env.d"):
+            with confedit.KeyValueFile("/target/etc/env.d/20language") as f:
+                f.set("LANG", "%s.UTF-8" % self.setup.language, quote=False)
+                f.set("LC_ALL", "%s.UTF-8" % self.setup.language, quote=False)
+            run("chroot||env-update")
+
+        # set the timezone
+        log(" --> Setting the timezone")
+        self.our_current += 1
+        self.update_progress(_("Setting timezone"))
+        confedit.atomic_write("/target/etc/timezone", "%s\n" % self.setup.timezone)
+        confedit.atomic_symlink("/usr/share/zoneinfo/%s" % self.setup.timezone,
+                                "/target/etc/localtime")
+
+        # Keyboard settings X11
+        if not self.setup.keyboard_variant:
+            self.setup.keyboard_variant = ""
+        self.update_progress(("Settings X11 keyboard options"))
+        if os.path.exists("/target/etc/X11/xorg.conf.d"):
+            newconsolefh = open(
+                "/target/etc/X11/xorg.conf.d/10-keyboard.conf", "w")
+        else:
+            newconsolefh = open(
+                "/target/usr/share/X11/xorg.conf.d/10-keyboard.conf", "w")
+        newconsolefh.write('Section "InputClass"\n')
+        newconsolefh.write('Identifier "system-keyboard"\n')
+        newconsolefh.write('MatchIsKeyboard "on"\n')
+        newconsolefh.write('Option "XkbLayout" "{}"\n'.format(
+            self.setup.keyboard_layout))
+        newconsolefh.write('Option "XkbModel" "{}"\n'.format(
+            self.setup.keyboard_model))
+        newconsolefh.write('Option "XkbVariant" "{}"\n'.format(
+            self.setup.keyboard_variant))
+        if "," in self.setup.keyboard_layout:
+            newconsolefh.write('Option "XkbOptions" "grp:ctrls_toggle"\n')
+        newconsolefh.write('EndSection\n')
+        newconsolefh.close()
+
+        # set the keyboard options..
+        log(" --> Setting the keyboard")
+        self.our_current += 1
+        self.update_progress(_("Setting keyboard options"))
+        if os.path.exists("/target/etc/default/console-setup"):
+            with confedit.KeyValueFile("/target/etc/default/console-setup") as f:
+                f.set("XKBMODEL", self.setup.keyboard_model, append=False)
+                f.set("XKBLAYOUT", self.setup.keyboard_layout, append=False)
+                if self.setup.keyboard_variant != "":
+                    f.set("XKBVARIANT", self.setup.keyboard_variant, append=False)
+
+        # lfs like systems uses vconsole.conf (systemd)
+        if os.path.exists("/target/etc/vconsole.conf"):
+            with confedit.KeyValueFile("/target/etc/vconsole.conf") as f:
+                if(self.setup.keyboard_variant != ""):
+                    f.set("KEYMAP", "{0}-{1}".format(self.setup.keyboard_layout,
+                                                     self.setup.keyboard_variant), append=False)
+                else:
+                    f.set("KEYMAP", self.setup.keyboard_layout, append=False)
+
+        # debian like systems uses this (systemd)
+        if os.path.exists("/target/etc/default/keyboard"):
+            with confedit.KeyValueFile("/target/etc/default/keyboard") as f:
+                f.set("XKBMODEL", self.setup.keyboard_model, append=False)
+                f.set("XKBLAYOUT", self.setup.keyboard_layout, append=False)
+                if self.setup.keyboard_variant != "":
+                    f.set("XKBVARIANT", self.setup.keyboard_variant, append=False)
+                f.set("XKBOPTIONS", "grp:ctrls_toggle", append=False)
+
+        # Keyboard settings openrc
+        if os.path.exists("/target/etc/conf.d/keymaps"):
+            if not self.setup.keyboard_layout:
+                self.setup.keyboard_layout = "en"
+            with confedit.KeyValueFile("/target/etc/conf.d/keymaps") as f:
+                f.set("keymap", "{}{}".format(self.setup.keyboard_layout,
+                                              self.setup.keyboard_variant))
+        return locale_stage
+
+    @asynchronous
+    def do_install_locale(self, locale):
+        log(" --> Installing locale %s" % locale)
+        if locales.install_locale(locale) != 0:
+            err("Failed to install locale %s" % locale)
+
+    def do_install_extra_packages(self):
+        packages = config.get("extra_packages", [])
+        if isinstance(packages, str):
+            # from kernel cmdline: extra_packages=pkg1,pkg2
+            packages = [p for p in packages.split(",") if p]
+        repo = config.get("local_repository", "")
+        if not packages:
+            return
+        if not repo or not os.path.isdir(repo):
+            err("Local repository not found: %s" % repo)
+            return
+        if "add_local_repository" not in config.pm:
+            err("Offline package installation not supported by %s" % config.pm["name"])
+            return
+        self.update_progress(_("Installing additional packages"), True)
+        log(" --> Installing additional packages: %s" % " ".join(packages))
+        mountpoint = "/var/cache/17g-repo"
+        # bind mount the cache instead of copying it into target
+        run("mkdir -p /target" + mountpoint)
+        run("mount --bind -o ro %s /target%s" % (repo, mountpoint))
+        # the package manager resolves versions and dependencies from the
+        # repository, one transaction for every package
+        run("chroot||" + config.pm["add_local_repository"].replace("{repo}", mountpoint))
+        run("chroot||" + config.package_manager("install_package", packages))
+        run("chroot||" + config.pm["remove_local_repository"].replace("{repo}", mountpoint))
+        self.do_unmount("/target" + mountpoint)
+        run("rmdir /target" + mountpoint)
+
     def do_configure_grub(self):
         log(" --> Running grub-mkconfig")
         grub_output = subprocess.getoutput(
@@ -0,0 +1,100 @@
+import os
+import shutil
+import subprocess
+import confedit
+from utils import run
+from logger import log, err, inf
+
+LOCALE_DIR = "/usr/lib/locale"
+LOCALE_ARCHIVE = LOCALE_DIR + "/locale-archive"
+
+
+def normalize(locale):
+    """tr_TR.UTF-8 -> tr_TR.utf8 (the name used inside locale archives)"""
+    if "." not in locale:
+        return locale
+    name, charset = locale.split(".", 1)
+    modifier = ""
+    if "@" in charset:
+        charset, modifier = charset.split("@", 1)
+        modifier = "@" + modifier
+    charset = charset.lower().replace("-", "").replace("_", "")
+    return name + "." + charset + modifier
+
+
+def archive_locales(prefix="/"):
+    """list locales available in the compiled archive under prefix"""
+    if not os.path.isfile(os.path.join(prefix, LOCALE_ARCHIVE.lstrip("/"))):
+        return []
+    cmd = ["localedef", "--list-archive"]
+    if prefix != "/":
+        cmd.insert(1, "--prefix=" + prefix)
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return output.decode("utf-8", "ignore").split()
+
+
+def has_locale(locale, prefix="/"):
+    """check precompiled data (archive or locale directory) for locale"""
+    name = normalize(locale)
+    if os.path.isdir(os.path.join(prefix, LOCALE_DIR.lstrip("/"), name)):
+        return True
+    return name in archive_locales(prefix)
+
+
+def enable_locale_gen(locale, target="/target"):
+    """uncomment or append locale in locale.gen so later locale-gen runs keep it"""
+    path = target + "/etc/locale.gen"
+    entry = "{} UTF-8".format(locale)
+    lines = []
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    found = False
+    for i, line in enumerate(lines):
+        if line.lstrip("#").strip() == entry:
+            lines[i] = entry
+            found = True
+    if not found:
+        lines.append(entry)
+    confedit.atomic_write(path, "\n".join(lines) + "\n")
+
+
+def copy_locale(locale, target="/target"):
+    """reuse precompiled locale data from the live system"""
+    name = normalize(locale)
+    src = os.path.join(LOCALE_DIR, name)
+    dst = target + src
+    if os.path.isdir(src):
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst, symlinks=True)
+    else:
+        os.makedirs(target + LOCALE_DIR, exist_ok=True)
+        shutil.copy2(LOCALE_ARCHIVE, target + LOCALE_ARCHIVE)
+
+
+def compile_locale(locale):
+    """compile only the selected locale inside target"""
+    lang, charset = locale.split(".", 1) if "." in locale else (locale, "UTF-8")
+    return run("chroot||localedef -i {0} -c -f {1} -A /usr/share/locale/locale.alias {0}.{1}".format(
+        lang, charset))
+
+
+def install_locale(locale, target="/target"):
+    """make locale available in target, compiling it only when no precompiled data exists"""
+    enable_locale_gen(locale, target)
+    if has_locale(locale, target):
+        inf("Locale {} already available in target".format(locale))
+        return 0
+    if has_locale(locale):
+        inf("Copying precompiled locale {} from live system".format(locale))
+        try:
+            copy_locale(locale, target)
+            return 0
+        except (OSError, shutil.Error) as e:
+            err("Failed to copy locale data: {}".format(e))
+    log("Compiling locale {}".format(locale))
+    return compile_locale(locale)
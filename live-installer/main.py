@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 import sys
 import traceback
+import capabilities
 from utils import *
 from frontend import *
 from frontend.dialogs import ErrorDialog
@@ -13,6 +14,9 @@ if (os.path.isdir("/usr/lib/live-installer")):
 if config.get("gtk_theme", "default") != "default":
     os.environ['GTK_THEME'] = config.get("gtk_theme")
 
+# Probe the host in the background while the ui comes up
+asynchronous(capabilities.host.probe_all)()
+
 # Force show mouse cursor & fix background
 os.system("xsetroot -cursor_name left_ptr")
 os.system("xsetroot -solid black")
@@ -37,6 +41,9 @@ if __name__ == "__main__":
         else:
             err("Welcome screen disabled by config.")
             exit(0)
+    elif "--check-media" in sys.argv:
+        import mediacheck
+        exit(mediacheck.main(sys.argv[sys.argv.index("--check-media") + 1:]))
     elif "--tui" in sys.argv:
         from frontend.tui_interface import InstallerWindow
         term = InstallerWindow()
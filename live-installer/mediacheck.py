@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+import os
+import sys
+import mmap
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+from logger import log, err, inf
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Integrity check of the live medium: streams the squashfs image (or the
+# whole device) with large O_DIRECT reads and hashes it in parallel chunks.
+# The expected checksums come from a sidecar written at build time:
+#
+#   mediacheck.py --generate /path/to/filesystem.squashfs
+#
+# writes filesystem.squashfs.chunksums. Without it, the whole image is
+# compared with a .sha512/.sha256/.md5 file or the medium's md5sum.txt.
+
+CHUNK = 16 * 1024 * 1024
+ALIGN = 4096
+HEADER = "# live-installer chunksums"
+
+
+def _read(path, default=""):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def hasher(name):
+    if name == "xxh3_128" and xxhash:
+        return xxhash.xxh3_128()
+    if name == "blake3" and blake3:
+        return blake3.blake3()
+    return hashlib.new(name)
+
+
+def find_image(device=None):
+    """ file behind the live system's loop device, else the device itself """
+    device = device or config.get("loop_directory", "/dev/loop0")
+    name = os.path.basename(os.path.realpath(device))
+    backing = _read("/sys/block/{}/loop/backing_file".format(name))
+    if backing and os.path.exists(backing):
+        return backing
+    return device
+
+
+def read_chunksums(path):
+    """ (algorithm, chunk size, image size, [hex digests]) from a .chunksums file """
+    fields, digests = {}, []
+    with open(path, "r") as f:
+        if f.readline().strip() != HEADER:
+            raise ValueError("not a chunksums file")
+        for line in f:
+            words = line.split()
+            if len(words) == 2:
+                fields[words[0]] = words[1]
+            elif len(words) == 1:
+                digests.append(words[0])
+    return fields["algorithm"], int(fields["chunk"]), int(fields["size"]), digests
+
+
+def _listed_digest(path, name):
+    """ digest of name in a "digest  name" list, or of the only entry """
+    lines = [line.split() for line in _read(path).splitlines() if line.strip()]
+    for words in lines:
+        if len(words) >= 2 and words[-1].lstrip("*").lstrip("./") == name:
+            return words[0]
+    if len(lines) == 1:
+        return lines[0][0]
+    return None
+
+
+def find_checksum(image):
+    """ ("chunks", algorithm, chunk, size, digests) or ("file", algorithm, digest), None if missing """
+    sums = image + ".chunksums"
+    if os.path.isfile(sums):
+        try:
+            return ("chunks",) + read_chunksums(sums)
+        except (OSError, ValueError, KeyError) as e:
+            err("Cannot read {}: {}".format(sums, e))
+    base = os.path.splitext(image)[0]
+    for algorithm in ("sha512", "sha256", "md5"):
+        for path in (image + "." + algorithm, base + "." + algorithm):
+            if os.path.isfile(path):
+                digest = _listed_digest(path, os.path.basename(image))
+                if digest:
+                    return ("file", algorithm, digest)
+    import devices  # not needed, nor importable, when generating at build time
+    md5sum = os.path.join(devices.LIVE_MEDIUM, "md5sum.txt")
+    if image.startswith(devices.LIVE_MEDIUM + "/") and os.path.isfile(md5sum):
+        digest = _listed_digest(md5sum, os.path.relpath(image, devices.LIVE_MEDIUM))
+        if digest:
+            return ("file", "md5", digest)
+    return None
+
+
+class MediaCheck:
+    ''' Reads an image at line rate and compares it with its build-time checksums '''
+
+    def __init__(self, path, workers=None, progress=None):
+        self.path = path
+        self.workers = workers or min(os.cpu_count() or 1, 8)
+        # progress(done bytes, total bytes, MB/s, seconds left)
+        self.progress = progress
+        self.cancelled = threading.Event()
+        self.stats = {"path": path, "mode": None, "size": 0, "ok": None,
+                      "bad_chunks": [], "direct": True}
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def open(self):
+        try:
+            return os.open(self.path, os.O_RDONLY | os.O_DIRECT)
+        except OSError:
+            # tmpfs (copied to RAM) has no O_DIRECT
+            self.stats["direct"] = False
+            return os.open(self.path, os.O_RDONLY)
+
+    def stream(self, fd, size, chunk, consume):
+        """ read size bytes in chunk sized blocks, consume(index, view, release) each """
+        buffers = queue.Queue()
+        for i in range(2 * self.workers + 1):
+            buffers.put(mmap.mmap(-1, chunk))  # page aligned for O_DIRECT
+        start = time.monotonic()
+        offset = index = 0
+        while offset < size and not self.cancelled.is_set():
+            buf = buffers.get()
+            length = os.preadv(fd, [buf], offset)
+            if length <= 0:
+                buffers.put(buf)
+                raise OSError("short read at offset {}".format(offset))
+            consume(index, memoryview(buf)[:length], lambda buf=buf: buffers.put(buf))
+            if not self.stats["direct"]:
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+            offset += length
+            index += 1
+            if self.progress:
+                elapsed = time.monotonic() - start
+                rate = offset / 1000000 / elapsed if elapsed else 0
+                left = (size - offset) / 1000000 / rate if rate else 0
+                self.progress(offset, size, rate, left)
+        for i in range(2 * self.workers + 1):
+            buffers.get()  # every block was hashed
+        return offset
+
+    def skip(self, index, view, release):
+        view.release()
+        release()
+
+    def check_chunks(self, fd, size, algorithm, chunk, digests):
+        if chunk % ALIGN:
+            raise ValueError("chunk size {} is not aligned".format(chunk))
+        bad = self.stats["bad_chunks"]
+
+        def work(index, view, release):
+            try:
+                h = hasher(algorithm)
+                h.update(view)
+                if index >= len(digests) or h.hexdigest() != digests[index]:
+                    bad.append(index)
+            finally:
+                view.release()
+                release()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            self.stream(fd, size, chunk,
+                        lambda index, view, release: pool.submit(work, index, view, release))
+        return not bad and len(digests) == -(-size // chunk)
+
+    def check_file(self, fd, size, algorithm, digest):
+        h = hasher(algorithm)
+
+        def work(index, view, release):
+            try:
+                h.update(view)
+            finally:
+                view.release()
+                release()
+        # one hash, in order, but reading the next blocks meanwhile
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            self.stream(fd, size, CHUNK,
+                        lambda index, view, release: pool.submit(work, index, view, release))
+        return h.hexdigest() == digest.lower()
+
+    def run(self):
+        """ the stats, "ok" is None without checksums or when cancelled """
+        start = time.monotonic()
+        expected = find_checksum(self.path)
+        fd = self.open()
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            self.stats["size"] = size
+            if expected is None:
+                err("No checksum found for {}, only checking that it reads".format(self.path))
+                self.stats["mode"] = "read"
+                self.stream(fd, size, CHUNK, self.skip)
+            elif expected[0] == "chunks":
+                self.stats["mode"] = "chunks/" + expected[1]
+                if expected[3] != size:
+                    err("{} is {} bytes, the checksums expect {}".format(self.path, size, expected[3]))
+                    self.stats["ok"] = False
+                else:
+                    self.stats["ok"] = self.check_chunks(fd, size, *expected[1:3], expected[4])
+            else:
+                self.stats["mode"] = "file/" + expected[1]
+                self.stats["ok"] = self.check_file(fd, size, *expected[1:])
+        except OSError as e:
+            err("Cannot read {}: {}".format(self.path, e))
+            self.stats["ok"] = False
+        finally:
+            os.close(fd)
+        if self.cancelled.is_set():
+            self.stats["ok"] = None
+        self.stats["bad_chunks"].sort()
+        elapsed = time.monotonic() - start
+        self.stats["seconds"] = round(elapsed, 1)
+        self.stats["mb_per_second"] = round(self.stats["size"] / 1000000 / elapsed, 1) if elapsed else 0
+        log("Media check: {}".format(self.stats))
+        return self.stats
+
+
+def generate(path, algorithm="blake2b", chunk=CHUNK):
+    """ write path.chunksums, run at build time on the finished image """
+    digests = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h = hasher(algorithm)
+            h.update(block)
+            digests.append(h.hexdigest())
+        size = f.tell()
+    with open(path + ".chunksums", "w") as f:
+        f.write("{}\nalgorithm {}\nchunk {}\nsize {}\n".format(HEADER, algorithm, chunk, size))
+        f.write("\n".join(digests) + "\n")
+    log("Wrote {}.chunksums ({} chunks)".format(path, len(digests)))
+
+
+def main(args):
+    """ text mode check, exit status 0 when the medium is good """
+    if args[:1] == ["--generate"]:
+        for path in args[1:]:
+            generate(path)
+        return 0
+
+    def progress(done, total, rate, left):
+        sys.stdout.write("\r{:3d}% {:6.0f} MB/s {:4.0f}s left ".format(
+            done * 100 // total if total else 100, rate, left))
+        sys.stdout.flush()
+    check = MediaCheck(args[0] if args else find_image(), progress=progress)
+    stats = check.run()
+    sys.stdout.write("\n")
+    if stats["ok"]:
+        inf("The live medium is fine")
+        return 0
+    if stats["ok"] is None:
+        inf("The live medium is readable, no checksum to compare with")
+        return 0
+    err("The live medium is damaged")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
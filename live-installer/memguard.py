@@ -0,0 +1,127 @@
+import time
+import threading
+import subprocess
+import config
+from utils import asynchronous
+from logger import log, err, inf
+
+# Keeps low-RAM live sessions alive while the system is copied: the live
+# system runs from RAM backed overlays, so the page cache and the copy
+# itself compete with it for memory.
+
+MEMINFO = "/proc/meminfo"
+PRESSURE = "/proc/pressure/memory"
+
+
+def meminfo(key):
+    """ value of key in /proc/meminfo, in kB """
+    try:
+        with open(MEMINFO, "r") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def pressure():
+    """ share of time (avg10, %) some task stalled on memory, 0 without PSI """
+    try:
+        with open(PRESSURE, "r") as f:
+            for line in f:
+                if line.startswith("some "):
+                    return float(line.split()[1].split("=")[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0.0
+
+
+class MemoryGuard:
+    ''' Watches MemAvailable and PSI, tells subscribers to back off when memory runs short '''
+
+    def __init__(self):
+        self.min_available = config.get("memguard_min_available_mb", 384) * 1024
+        self.max_pressure = float(config.get("memguard_max_pressure", 20))
+        # never stall the copy for longer than this, memory may be held by others
+        self.max_pause = float(config.get("memguard_max_pause", 30))
+        self.interval = float(config.get("memguard_interval", 1))
+        self.listeners = []
+        self.throttled = False
+        self.since = self.grace = 0
+        self.swaps = []
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {"throttled": 0, "throttled_seconds": 0.0, "min_available_kb": None}
+
+    def tight(self):
+        """ too little RAM to copy comfortably """
+        limit = config.get("memguard_swap_below_mb", 4096) * 1024
+        return meminfo("MemTotal") < limit or meminfo("MemAvailable") < 2 * self.min_available
+
+    def enable_swap(self, devices):
+        """ swapon the new target swap before the copy when RAM is tight """
+        if not self.tight():
+            return
+        for device in devices:
+            if device and subprocess.call(["swapon", device]) == 0:
+                inf("Low memory, enabled swap on %s" % device)
+                self.swaps.append(device)
+
+    def disable_swap(self):
+        for device in self.swaps:
+            subprocess.call(["swapoff", device])
+        self.swaps = []
+
+    def subscribe(self, callback):
+        """ callback(throttled) whenever the state changes """
+        self.listeners.append(callback)
+
+    def set_throttled(self, throttled):
+        if throttled == self.throttled:
+            return
+        self.throttled = throttled
+        if throttled:
+            self.stats["throttled"] += 1
+            self.since = time.monotonic()
+        else:
+            self.stats["throttled_seconds"] += time.monotonic() - self.since
+        log("Memory guard: %s (available %d kB, pressure %.1f%%)" % (
+            "throttling" if throttled else "resuming", meminfo("MemAvailable"), pressure()))
+        for callback in self.listeners:
+            try:
+                callback(throttled)
+            except Exception as e:
+                err("Memory guard listener failed: %s" % e)
+
+    def check(self):
+        available, stall = meminfo("MemAvailable"), pressure()
+        now = time.monotonic()
+        if self.stats["min_available_kb"] is None or available < self.stats["min_available_kb"]:
+            self.stats["min_available_kb"] = available
+        if self.throttled and now - self.since > self.max_pause:
+            self.set_throttled(False)
+            self.grace = now + self.max_pause
+        elif now < self.grace:
+            pass
+        elif available < self.min_available or stall > self.max_pressure:
+            self.set_throttled(True)
+        elif available > 2 * self.min_available and stall < self.max_pressure / 2:
+            # hysteresis, don't flap around the limits
+            self.set_throttled(False)
+
+    @asynchronous
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = self.watch()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.set_throttled(False)
+        log("Memory guard: {}".format(self.stats))
@@ -0,0 +1,102 @@
+import os
+import stat
+import threading
+import config
+import copier
+import memguard
+import capabilities
+from utils import asynchronous
+from logger import log, err
+
+# Work which does not depend on the user's answers, done while the wizard
+# is still open: mount the live filesystem, scan it and read the first
+# files of the copy into the page cache (in the native engine's read order,
+# or in directory order for rsync).
+
+
+class PreWork:
+    ''' Background preparation of the copy, cancelled once the real work starts '''
+
+    def __init__(self, installer):
+        self.installer = installer
+        self.cancelled = threading.Event()
+        self.thread = None
+        self.manifest = None
+        self.stats = {"mounted": False, "entries": 0, "readahead_bytes": 0}
+
+    def start(self):
+        if config.get("prework", True):
+            self.thread = self.run()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self):
+        if self.thread:
+            self.thread.join()
+
+    def take_manifest(self):
+        """ stop the pre-work, returns the scanned entries if the scan completed """
+        self.cancel()
+        self.wait()
+        log("Pre-work: {}".format(self.stats))
+        manifest, self.manifest = self.manifest, None
+        return manifest
+
+    @asynchronous
+    def run(self):
+        try:
+            capabilities.host.probe_all()
+            if self.cancelled.is_set() or not self.mount_source():
+                return
+            if config.get("install_mode", "copy") == "image":
+                return  # nothing is copied file by file
+            engine = copier.Copier(self.installer.source, self.installer.target,
+                                   self.installer.copy_excludes(),
+                                   order=config.get("copy_order", "layout"),
+                                   layout=copier.load_layout(config.get("copy_layout_file", None)))
+            entries = []
+            for entry in engine.scan():
+                if self.cancelled.is_set():
+                    return
+                entries.append(entry)
+            self.stats["entries"] = len(entries)
+            if config.get("copy_engine", "rsync") == "native":
+                self.manifest = entries
+                self.readahead(engine.schedule(entries))
+            else:
+                # rsync walks the tree itself, the scan left its inodes
+                # cached and the first files are read in directory order
+                self.readahead(entries)
+        except Exception as e:
+            err("Pre-work failed: {}".format(e))
+
+    def mount_source(self):
+        if os.path.ismount(self.installer.source):
+            return True
+        os.makedirs(self.installer.source, exist_ok=True)
+        if self.installer.do_mount(self.installer.media, self.installer.source) != 0:
+            return False
+        self.stats["mounted"] = True
+        return True
+
+    def readahead(self, entries):
+        """ WILLNEED the first files of the copy, within a share of the free memory """
+        budget = min(config.get("prework_readahead_mb", 512) * 1024 * 1024,
+                     memguard.meminfo("MemAvailable") * 1024 // 4)
+        for relpath, st in entries:
+            if self.cancelled.is_set() or budget <= 0:
+                break
+            if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                continue
+            size = min(st.st_size, budget)
+            try:
+                fd = os.open(os.path.join(self.installer.source, relpath), os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                continue
+            budget -= size
+            self.stats["readahead_bytes"] += size
@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+import threading
+import subprocess
+import confedit
+from logger import log, err
+
+CACHE_FILE = "/tmp/live-installer/probe-cache.json"
+# covers the superblocks of ext*, vfat, ntfs, xfs (offset 0) and btrfs (64 KiB)
+SUPERBLOCK_AREA = 68 * 1024
+FIELDS = ("type", "size", "raw_size", "free_space", "used_percent",
+          "description", "os_fs_info", "efi")
+
+_lock = threading.Lock()
+_cache = None
+
+
+def _load():
+    global _cache
+    if _cache is None:
+        _cache = {}
+        if os.path.isfile(CACHE_FILE):
+            try:
+                with open(CACHE_FILE, "r") as f:
+                    _cache = json.load(f)
+            except (OSError, ValueError) as e:
+                err("Ignoring probe cache: {}".format(e))
+    return _cache
+
+
+def get_uuid(path):
+    try:
+        return subprocess.check_output(["blkid", "-p", "-s", "UUID", "-o", "value", path],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def superblock_hash(path):
+    """ changes whenever the filesystem writes its superblock (mount count, wtime, generation ...) """
+    try:
+        with open(path, "rb") as f:
+            return hashlib.blake2b(f.read(SUPERBLOCK_AREA), digest_size=16).hexdigest()
+    except OSError:
+        return ""
+
+
+def identity(path, start, length, uuid=None):
+    """ cache key of a partition: device path, geometry, fs uuid and superblock state """
+    if uuid is None:
+        uuid = get_uuid(path)
+    return "{}:{}:{}:{}:{}".format(path, start, length, uuid, superblock_hash(path))
+
+
+def lookup(key):
+    with _lock:
+        return _load().get(key)
+
+
+def store(key, values):
+    with _lock:
+        cache = _load()
+        # drop stale entries of the same device
+        path = key.split(":", 1)[0] + ":"
+        for old in [k for k in cache if k.startswith(path)]:
+            del cache[old]
+        cache[key] = dict((k, values[k]) for k in FIELDS if k in values)
+        _save(cache)
+
+
+def _save(cache):
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        confedit.atomic_write(CACHE_FILE, json.dumps(cache))
+    except OSError as e:
+        err("Could not write probe cache: {}".format(e))
+
+
+def on_disk(key, disk_path):
+    """ True if key is a partition of disk_path (sda1, nvme0n1p1, mmcblk0p1) """
+    path = key.split(":", 1)[0]
+    return path.startswith(disk_path) and path[len(disk_path):].lstrip("p").isdigit()
+
+
+def invalidate(disk_path=None):
+    """ forget the partitions of a repartitioned disk, everything with None """
+    with _lock:
+        cache = _load()
+        for key in [k for k in cache if disk_path is None or on_disk(k, disk_path)]:
+            del cache[key]
+        _save(cache)
+    log("Probe cache invalidated: {}".format(disk_path or "all"))
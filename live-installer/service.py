@@ -4,6 +4,7 @@
 import os
 import sys
 import config
+import capabilities
 from utils import err, is_root, run
 if not is_root():
     print("You must be root!")
@@ -28,12 +29,12 @@ if config.get("welcome_screen", True):
 
 # live functions
 # Ignore this function with debian (debian uses live-config package)
-if config.get("enable_live", True) and (0 != os.system("which live-config &>/dev/null")):
+if config.get("enable_live", True) and not capabilities.host.has_tool("live-config"):
     if config.get("live_user", "user"):
         os.system("useradd -m \"{}\" -s \"{}\"".format(config.get("live_user",
                                                                   "user"), config.get("using_shell", "/bin/bash")))
         if config.get("live_password", "live"):
-            if os.system("which chpasswd &>/dev/null") == 0:
+            if capabilities.host.has_tool("chpasswd"):
                 fp = open("/tmp/.passwd", "w")
                 fp.write("{}:{}\n".format(
                     config.get("live_user", "user"), config.get("live_password", "live")))
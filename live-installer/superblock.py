@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+import sys
+import uuid
+import struct
+from array import array
+from logger import log, err
+
+# Reads filesystem size, free space and UUID straight from the on-disk
+# superblocks, without mounting. Values of a mounted filesystem may lag
+# behind until it is synced.
+
+AREA_SIZE = 68 * 1024  # up to and including the btrfs superblock at 64 KiB
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _u(fmt, data, offset):
+    return struct.unpack_from(fmt, data, offset)[0]
+
+
+def probe_ext(f, area):
+    sb = area[1024:2048]
+    if len(sb) < 1024 or _u("<H", sb, 0x38) != 0xEF53:
+        return None
+    block_size = 1024 << _u("<I", sb, 0x18)
+    compat, incompat = _u("<I", sb, 0x5C), _u("<I", sb, 0x60)
+    blocks, reserved, free = _u("<I", sb, 0x04), _u("<I", sb, 0x08), _u("<I", sb, 0x0C)
+    if incompat & 0x80:  # 64bit
+        blocks |= _u("<I", sb, 0x150) << 32
+        reserved |= _u("<I", sb, 0x154) << 32
+        free |= _u("<I", sb, 0x158) << 32
+    if incompat & 0x2C0:  # extents, 64bit, flex_bg
+        typevar = "ext4"
+    elif compat & 0x4:  # has_journal
+        typevar = "ext3"
+    else:
+        typevar = "ext2"
+    return {"type": typevar,
+            "size": blocks * block_size,
+            "free": max(0, free - reserved) * block_size,
+            "used": (blocks - free) * block_size,
+            "uuid": str(uuid.UUID(bytes=sb[0x68:0x78]))}
+
+
+def probe_xfs(f, area):
+    if area[0:4] != b"XFSB":
+        return None
+    block_size = _u(">I", area, 4)
+    blocks, fdblocks = _u(">Q", area, 8), _u(">Q", area, 144)
+    return {"type": "xfs",
+            "size": blocks * block_size,
+            "free": fdblocks * block_size,
+            "used": (blocks - fdblocks) * block_size,
+            "uuid": str(uuid.UUID(bytes=area[32:48]))}
+
+
+def probe_btrfs(f, area):
+    sb = area[0x10000:0x10000 + 4096]
+    if len(sb) < 4096 or sb[64:72] != b"_BHRfS_M":
+        return None
+    total, used = _u("<Q", sb, 112), _u("<Q", sb, 120)
+    return {"type": "btrfs",
+            "size": total,
+            "free": total - used,
+            "used": used,
+            "uuid": str(uuid.UUID(bytes=sb[32:48]))}
+
+
+def probe_swap(f, area):
+    for page_size in (4096, 8192, 16384, 65536):
+        if area[page_size - 10:page_size] in (b"SWAPSPACE2", b"SWAP-SPACE"):
+            last_page = _u("<I", area, 1028)
+            return {"type": "swap",
+                    "size": last_page * page_size,
+                    "free": 0,
+                    "used": 0,
+                    "uuid": str(uuid.UUID(bytes=area[1036:1052]))}
+    return None
+
+
+def probe_vfat(f, area):
+    if area[510:512] != b"\x55\xaa" or area[3:11] == b"NTFS    ":
+        return None
+    bps, spc = _u("<H", area, 11), area[13]
+    reserved, fats, root_entries = _u("<H", area, 14), area[16], _u("<H", area, 17)
+    total = _u("<H", area, 19) or _u("<I", area, 32)
+    fat_size = _u("<H", area, 22) or _u("<I", area, 36)
+    if bps not in (512, 1024, 2048, 4096) or not spc or not fats or not total:
+        return None
+    root_sectors = (root_entries * 32 + bps - 1) // bps
+    data_start = reserved + fats * fat_size + root_sectors
+    clusters = (total - data_start) // spc
+    cluster_size = spc * bps
+    free = None
+    if clusters >= 65525:
+        # FAT32: FSInfo sector keeps the free cluster count
+        fsinfo = _read(f, _u("<H", area, 48) * bps, 512)
+        if _u("<I", fsinfo, 0) == 0x41615252 and _u("<I", fsinfo, 484) == 0x61417272:
+            count = _u("<I", fsinfo, 488)
+            if count <= clusters:
+                free = count
+        serial = _u("<I", area, 67)
+    else:
+        serial = _u("<I", area, 39)
+    if free is None:
+        fat = _read(f, reserved * bps, fat_size * bps)
+        if clusters >= 65525:
+            entries = array("I", fat[:(clusters + 2) * 4])
+            free = sum(1 for e in entries[2:] if not e & 0x0FFFFFFF)
+        elif clusters >= 4085:
+            free = array("H", fat[:(clusters + 2) * 2])[2:].count(0)
+        else:
+            free = 0
+            for n in range(2, clusters + 2):
+                value = _u("<H", fat, n * 3 // 2)
+                if not (value >> 4 if n & 1 else value & 0xFFF):
+                    free += 1
+    return {"type": "vfat",
+            "size": clusters * cluster_size,
+            "free": free * cluster_size,
+            "used": (clusters - free) * cluster_size,
+            "uuid": "{:04X}-{:04X}".format(serial >> 16, serial & 0xFFFF)}
+
+
+def _ntfs_runs(data):
+    """ decode a non-resident attribute runlist into (lcn, length) pairs """
+    runs, pos, lcn = [], 0, 0
+    while pos < len(data) and data[pos]:
+        length_size, offset_size = data[pos] & 0xF, data[pos] >> 4
+        pos += 1
+        length = int.from_bytes(data[pos:pos + length_size], "little")
+        pos += length_size
+        if offset_size:
+            lcn += int.from_bytes(data[pos:pos + offset_size], "little", signed=True)
+            runs.append((lcn, length))
+        else:
+            runs.append((None, length))  # sparse
+        pos += offset_size
+    return runs
+
+
+def probe_ntfs(f, area):
+    if area[3:11] != b"NTFS    ":
+        return None
+    bps, spc = _u("<H", area, 11), area[13]
+    if spc > 0x80:
+        spc = 1 << (256 - spc)
+    cluster_size = bps * spc
+    clusters = _u("<Q", area, 40) // spc
+    mft = _u("<Q", area, 48) * cluster_size
+    record_size = _u("<b", area, 64)
+    record_size = record_size * cluster_size if record_size > 0 else 1 << -record_size
+    info = {"type": "ntfs",
+            "size": clusters * cluster_size,
+            "uuid": "{:016X}".format(_u("<Q", area, 72))}
+    # MFT record 6 is $Bitmap, one bit per cluster in use
+    record = bytearray(_read(f, mft + 6 * record_size, record_size))
+    if record[0:4] != b"FILE":
+        return info
+    usa_offset, usa_count = _u("<H", record, 4), _u("<H", record, 6)
+    for i in range(1, usa_count):
+        end = i * bps - 2
+        record[end:end + 2] = record[usa_offset + i * 2:usa_offset + i * 2 + 2]
+    offset = _u("<H", record, 20)
+    while offset + 16 <= len(record):
+        attr_type, attr_len = _u("<I", record, offset), _u("<I", record, offset + 4)
+        if attr_type == 0xFFFFFFFF or attr_len == 0:
+            break
+        if attr_type == 0x80 and record[offset + 8]:
+            attr = record[offset:offset + attr_len]
+            remaining = _u("<Q", attr, 48)
+            used = 0
+            for lcn, length in _ntfs_runs(attr[_u("<H", attr, 32):]):
+                size = min(length * cluster_size, remaining)
+                if lcn is not None:
+                    used += int.from_bytes(_read(f, lcn * cluster_size, size), "little").bit_count()
+                remaining -= size
+                if remaining <= 0:
+                    break
+            info["used"] = used * cluster_size
+            info["free"] = (clusters - used) * cluster_size
+            break
+        offset += attr_len
+    return info
+
+
+PROBES = (probe_ext, probe_xfs, probe_btrfs, probe_swap, probe_ntfs, probe_vfat)
+
+
+def probe(path):
+    """ {type, size, free, used, uuid} of the filesystem on path, None if unknown """
+    try:
+        with open(path, "rb") as f:
+            area = f.read(AREA_SIZE)
+            for function in PROBES:
+                try:
+                    info = function(f, area)
+                except (struct.error, ValueError, IndexError) as e:
+                    err("Corrupt superblock on {} ({}): {}".format(
+                        path, function.__name__, e))
+                    continue
+                if info:
+                    return info
+    except OSError as e:
+        err("Could not read {}: {}".format(path, e))
+    return None
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        log("{}: {}".format(path, probe(path)))
@@ -0,0 +1,119 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import copier
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+class RepairTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, "source")
+        self.target = os.path.join(self.tmp, "target")
+        write(os.path.join(self.source, "etc/passwd"), "root:x:0:0::/root:/bin/sh\n")
+        write(os.path.join(self.source, "etc/os-release"), "NAME=new\n")
+        write(os.path.join(self.source, "usr/bin/tool"), "new tool\n")
+        # an installed system with its own accounts and an ESP mounted in it
+        write(os.path.join(self.target, "etc/passwd"), "root:x:0:0::/root:/bin/sh\nuser:x:1000:1000::/home/user:/bin/sh\n")
+        write(os.path.join(self.target, "etc/os-release"), "NAME=old\n")
+        write(os.path.join(self.target, "usr/bin/obsolete"), "old\n")
+        write(os.path.join(self.target, "root/.profile"), "kept\n")
+        write(os.path.join(self.target, "boot/efi/EFI/Microsoft/bootmgfw.efi"), "other os\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def repair(self):
+        esp = os.path.join(self.target, "boot/efi")
+        ismount = os.path.ismount
+        with mock.patch("os.path.ismount", lambda path: path == esp or ismount(path)):
+            engine = copier.Copier(self.source, self.target, streaming=False, delta=True,
+                                   keep=["etc/passwd", "root"])
+            return engine.run()
+
+    def test_kept_files_survive(self):
+        self.repair()
+        self.assertIn("user:x:1000", read(os.path.join(self.target, "etc/passwd")))
+        self.assertEqual(read(os.path.join(self.target, "root/.profile")), "kept\n")
+
+    def test_image_files_updated(self):
+        stats = self.repair()
+        self.assertEqual(read(os.path.join(self.target, "etc/os-release")), "NAME=new\n")
+        self.assertEqual(read(os.path.join(self.target, "usr/bin/tool")), "new tool\n")
+        self.assertFalse(os.path.exists(os.path.join(self.target, "usr/bin/obsolete")))
+        self.assertEqual(stats["errors"], 0)
+
+    def test_other_filesystems_untouched(self):
+        self.repair()
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.target, "boot/efi/EFI/Microsoft/bootmgfw.efi")))
+
+    def test_type_changes(self):
+        # a file where the image has a directory and the other way round
+        write(os.path.join(self.source, "usr/lib/plugin/a.so"), "a\n")
+        write(os.path.join(self.target, "usr/lib/plugin"), "old file\n")
+        write(os.path.join(self.source, "usr/share/doc"), "now a file\n")
+        write(os.path.join(self.target, "usr/share/doc/old/README"), "old\n")
+        stats = self.repair()
+        self.assertEqual(read(os.path.join(self.target, "usr/lib/plugin/a.so")), "a\n")
+        self.assertEqual(read(os.path.join(self.target, "usr/share/doc")), "now a file\n")
+        self.assertEqual(stats["errors"], 0)
+
+
+class RsyncRepairTest(RepairTest):
+
+    def repair(self):
+        command = copier.rsync_command(self.source, self.target, ["home/*", "lost+found"],
+                                       delta=True, keep=["etc/passwd", "root", "boot/efi"])
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        return {"errors": 0}
+
+    def setUp(self):
+        if shutil.which("rsync") is None:
+            self.skipTest("rsync is not installed")
+        super().setUp()
+        write(os.path.join(self.source, "home/.keep"), "")
+        write(os.path.join(self.source, "boot/vmlinuz"), "kernel\n")
+        write(os.path.join(self.target, "home/user/notes"), "mine\n")
+        write(os.path.join(self.target, "lost+found/#1234"), "recovered\n")
+
+    def test_home_untouched(self):
+        self.repair()
+        self.assertEqual(read(os.path.join(self.target, "home/user/notes")), "mine\n")
+        self.assertTrue(os.path.isfile(os.path.join(self.target, "lost+found/#1234")))
+
+
+class RsyncCommandTest(unittest.TestCase):
+
+    def test_patterns_anchored_at_the_source(self):
+        command = copier.rsync_command("/source/", "/target/", ["home/*", "/home"],
+                                       delta=True, keep=["etc/passwd", "boot/efi"])
+        self.assertIn("--exclude=/home/*", command)
+        self.assertIn("--exclude=/etc/passwd", command)
+        self.assertIn("--exclude=/home", command)
+        self.assertFalse([c for c in command if c.startswith("--exclude=/source")])
+        self.assertEqual(command[-2:], ["/source/", "/target/"])
+
+    def test_no_delete_without_delta(self):
+        self.assertNotIn("--delete", copier.rsync_command("/source", "/target", ["proc/*"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,7 @@ import subprocess
 import sys
 import threading
 import config
+import capabilities
 from gi.repository import GObject
 from logger import log, err, inf
 
@@ -102,9 +103,7 @@ def run(cmd, vital=True):
 
 
 def is_efi_supported():
-    # Are we running under with efi ?
-    run("modprobe efivars &>/dev/null")
-    return os.path.exists("/proc/efi") or os.path.exists("/sys/firmware/efi")
+    return capabilities.host.efi
 
 
 def path_exists(*args):
@@ -0,0 +1,144 @@
+import os
+import stat
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logger import log, err
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Reads the copied files back from the target disk and compares them with
+# the digests taken while copying (or the live system when there are none),
+# so a flaky USB stick or disk fails the install instead of leaving a
+# silently broken system.
+
+CHUNK = 4 * 1024 * 1024
+
+
+def hash_name():
+    if xxhash:
+        return "xxh3_128"
+    if blake3:
+        return "blake3"
+    return "blake2b"
+
+
+def new_hash():
+    """ fastest available hash, none of them is used for security here """
+    if xxhash:
+        return xxhash.xxh3_128()
+    if blake3:
+        return blake3.blake3()
+    return hashlib.blake2b(digest_size=16)
+
+
+def digest(path, drop=False):
+    """ (digest, size) of path, drop: read from the disk, not the page cache """
+    h = new_hash()
+    size = 0
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        if drop:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            block = os.read(fd, CHUNK)
+            if not block:
+                break
+            h.update(block)
+            size += len(block)
+        # verified once, nobody reads these pages again
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return h.digest(), size
+
+
+class Verifier:
+    ''' Compares the regular files of a copy with their source, in parallel '''
+
+    def __init__(self, source, target, entries, workers=4, recopy=None, progress=None,
+                 digests=None):
+        self.source = source.rstrip("/") or "/"
+        self.target = target.rstrip("/") or "/"
+        self.workers = max(1, workers)
+        # recopy(relpath, st) writes the file again, e.g. Copier.copy_file
+        self.recopy = recopy
+        # {relpath: digest} of the source data, hashed by the copier
+        self.digests = digests if digests is not None else {}
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.files = []
+        inodes = set()
+        for relpath, st in entries:
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if st.st_nlink > 1:
+                # hardlinks share the data, checking one name is enough
+                if (st.st_dev, st.st_ino) in inodes:
+                    continue
+                inodes.add((st.st_dev, st.st_ino))
+            self.files.append((relpath, st))
+        self.bad = []
+        self.stats = {"hash": hash_name(), "files": 0, "bytes": 0, "mismatched": 0,
+                      "recopied": 0, "failed": 0, "source_reads": 0}
+
+    def check(self, relpath, st):
+        """ True if the target copy has the source's size and content """
+        try:
+            target_digest, size = digest(os.path.join(self.target, relpath), drop=True)
+            if size != st.st_size:
+                return False
+            source_digest = self.digests.get(relpath)
+            if source_digest is None:
+                # not hashed while copying, e.g. another name of a hardlink
+                with self.lock:
+                    self.stats["source_reads"] += 1
+                source_digest, size = digest(os.path.join(self.source, relpath))
+            return size == st.st_size and source_digest == target_digest
+        except OSError as e:
+            err("Cannot verify {}: {}".format(relpath, e))
+            return False
+
+    def verify(self, relpath, st):
+        good = self.check(relpath, st)
+        with self.lock:
+            if not good:
+                self.bad.append((relpath, st))
+            self.stats["files"] += 1
+            self.stats["bytes"] += st.st_size
+            done = self.stats["bytes"]
+        if self.progress:
+            self.progress(relpath, done)
+
+    def run(self):
+        """ verify everything, copy the mismatched files again, returns the stats """
+        start = time.monotonic()
+        # flush the copy so the target is read back from the disk
+        os.sync()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(self.verify, relpath, st) for relpath, st in self.files]:
+                future.result()
+        self.stats["mismatched"] = len(self.bad)
+        for relpath, st in self.bad:
+            err("Copy of /{} differs from the source".format(relpath))
+            if self.recopy:
+                self.recopy(relpath, st)
+                os.sync()
+                self.stats["recopied"] += 1
+                if self.check(relpath, st):
+                    continue
+            err("Copy of /{} is still broken".format(relpath))
+            self.stats["failed"] += 1
+        elapsed = time.monotonic() - start
+        self.stats["seconds"] = round(elapsed, 1)
+        self.stats["mb_per_second"] = round(self.stats["bytes"] / 1000000 / elapsed, 1) if elapsed else 0
+        log("Verification finished: {}".format(self.stats))
+        return self.stats